@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import random
+import typing
+
+""" Local stand-in for AsyncElasticsearch, answering Blocky's searches with canned aggregation results """
+
+PERIOD = 43200  # Clients send their requests evenly spread over this many seconds, repeating
+
+
+class FakeIndices:
+    def __init__(self, es: "FakeElasticsearch"):
+        self.es = es
+
+    async def exists(self, index: str) -> bool:
+        await self.es.wait()
+        return True
+
+
+class FakeElasticsearch:
+    """Answers the top-client (terms), composite and incremental (terms + date_histogram) aggregations that Blocky
+    sends, from a fixed, seeded population of clients, after sleeping for $latency seconds (plus up to $jitter more)
+    per request. Clients get request counts spread between 1 and $max_requests, so any rule limit in that range finds
+    a predictable share of offenders.
+
+    Searches over the past hours or days (now-12h and the like) see each client's full count. Searches over a fixed
+    time range, as incremental rules send, see only the traffic sent within it, at a steady rate of each client's
+    count per PERIOD seconds. A backfill of a 12 hour window thus adds up to the full counts, while the slices that
+    follow only find the few requests made since the previous cycle."""
+
+    def __init__(
+        self,
+        clients: int = 10000,
+        latency: float = 0.01,
+        jitter: float = 0.0,
+        max_requests: int = 100000,
+        seed: int = 42,
+    ):
+        rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng
+        self.clients = []  # (ip, requests, bytes) of each client, sorted by IP as composite aggregations are
+        for _ in range(clients):
+            ip = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+            count = rng.randint(1, max_requests)
+            self.clients.append((ip, count, count * 2000))
+        self.clients.sort()
+        self.by_requests = sorted(self.clients, key=lambda client: client[1], reverse=True)
+        self.by_bytes = sorted(self.clients, key=lambda client: client[2], reverse=True)
+        self.indices = FakeIndices(self)
+        self.requests = 0
+
+    async def wait(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency + (self.rng.random() * self.jitter if self.jitter else 0))
+
+    async def info(self) -> dict:
+        return {"version": {"number": "7.17.0"}}
+
+    async def search(self, index: str = None, body: dict = None, size: int = 0, timeout: str = None) -> dict:
+        await self.wait()
+        return self.answer(body)
+
+    async def msearch(self, body: typing.List[dict]) -> dict:
+        await self.wait()
+        return {"responses": [self.answer(query) for query in body[1::2]]}
+
+    def answer(self, body: dict) -> dict:
+        time_range = self.time_range(body)
+        aggregations = {}
+        for name, agg in body.get("aggs", {}).items():
+            if "composite" in agg:
+                aggregations[name] = self.composite(agg)
+            elif "slices" in agg.get("aggs", {}):
+                aggregations[name] = self.incremental(agg, *time_range)
+            else:
+                aggregations[name] = self.terms(agg, time_range)
+        return {"took": 1, "timed_out": False, "aggregations": aggregations}
+
+    @staticmethod
+    def time_range(body: dict) -> typing.Optional[typing.Tuple[int, int]]:
+        """Returns the (since, until] range of a search in epoch seconds, or None for a range relative to now"""
+        for search_filter in body.get("query", {}).get("bool", {}).get("filter", []):
+            time_range = next(iter(search_filter.get("range", {}).values()), {})
+            if "gt" in time_range and "lte" in time_range:
+                return int(time_range["gt"]) // 1000, int(time_range["lte"]) // 1000
+        return None
+
+    def within(self, since: int, until: int) -> typing.Iterator[typing.Tuple[str, int, int]]:
+        """Yields the (ip, requests, bytes) of every client with any requests in a time range, busiest first"""
+        seconds = max(0, until - since)
+        for ip, count, traffic in self.by_requests:
+            count = count * seconds // PERIOD
+            if not count:
+                break  # Clients are sorted by count, so the rest have no requests in this range either
+            yield ip, count, count * 2000
+
+    @staticmethod
+    def limit_of(agg: dict) -> int:
+        """Returns the limit of a bucket_selector, if the aggregation has one"""
+        for sub_agg in agg.get("aggs", {}).values():
+            if "bucket_selector" in sub_agg:
+                return sub_agg["bucket_selector"]["script"]["params"]["limit"]
+        return 0
+
+    def terms(self, agg: dict, time_range: typing.Tuple[int, int] = None) -> dict:
+        terms = agg["terms"]
+        clients = list(self.within(*time_range)) if time_range else None
+        if "bytes_sum" in agg.get("aggs", {}):
+            limit = self.limit_of(agg)
+            return {
+                "buckets": [
+                    {"key": ip, "doc_count": count, "bytes_sum": {"value": float(traffic)}}
+                    for ip, count, traffic in (self.by_bytes if clients is None else clients)[: terms["size"]]
+                    if traffic >= limit
+                ]
+            }
+        limit = terms.get("min_doc_count", 1)
+        return {
+            "buckets": [
+                {"key": ip, "doc_count": count}
+                for ip, count, _traffic in (self.by_requests if clients is None else clients)[: terms["size"]]
+                if count >= limit
+            ]
+        }
+
+    def composite(self, agg: dict) -> dict:
+        composite = agg["composite"]
+        with_bytes = "bytes_sum" in agg.get("aggs", {})
+        limit = self.limit_of(agg)
+        after = composite.get("after", {}).get("ip")
+        page = [client for client in self.clients if after is None or client[0] > after][: composite["size"]]
+        buckets = []
+        for ip, count, traffic in page:
+            if (traffic if with_bytes else count) >= limit:
+                bucket = {"key": {"ip": ip}, "doc_count": count}
+                if with_bytes:
+                    bucket["bytes_sum"] = {"value": float(traffic)}
+                buckets.append(bucket)
+        result = {"buckets": buckets}
+        if len(page) == composite["size"]:
+            result["after_key"] = {"ip": page[-1][0]}
+        return result
+
+    def incremental(self, agg: dict, since: int, until: int) -> dict:
+        """Splits the traffic each client sent within (since, until] into the time buckets of the date_histogram"""
+        slices = agg["aggs"]["slices"]
+        with_bytes = "bytes_sum" in slices.get("aggs", {})
+        interval = int(slices["date_histogram"]["fixed_interval"].rstrip("s"))
+        edges = []  # (start, since, until) of each bucket's share of the range
+        start = since - since % interval
+        while start < until:
+            edges.append((start, max(since, start), min(until, start + interval)))
+            start += interval
+        buckets = []
+        for ip, count, _traffic in self.by_requests[: agg["terms"]["size"]]:
+            time_slices = []
+            for start, bucket_since, bucket_until in edges:
+                bucket_count = count * (bucket_until - bucket_since) // PERIOD
+                if bucket_count:
+                    time_slice = {"key": start * 1000, "doc_count": bucket_count}
+                    if with_bytes:
+                        time_slice["bytes_sum"] = {"value": float(bucket_count * 2000)}
+                    time_slices.append(time_slice)
+            if not time_slices:
+                break
+            total = sum(time_slice["doc_count"] for time_slice in time_slices)
+            buckets.append({"key": ip, "doc_count": total, "slices": {"buckets": time_slices}})
+        return {"buckets": buckets}
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import asyncio
+import atexit
+import gc
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import benchmarks.fake_es
+import plugins.background
+import plugins.configuration
+import plugins.lists
+
+""" Offline benchmarks for Blocky/4.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.run --sizes 1000,100000 --output bench.json
+
+Each list size and IP version gets a fresh temporary SQLite database, filled with a synthetic block list of that
+size (and an allow list a tenth of it), and a FakeElasticsearch in place of the real thing. Results are written as
+JSON, tagged with the current git commit, so runs can be compared across commits.
+"""
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+DEFAULT_FAMILIES = (4, 6)
+ADD_OPERATIONS = 1000  # Number of list additions (and of conflicting additions) to time
+SEARCH_OPERATIONS = 1000  # Number of /search requests to time
+UPLOAD_RULES = 20000  # Size of the iptables upload to time, about what fits in max_upload
+RUN_CYCLES = 3  # Cycles to time per rule mode. The first one blocks the offenders, later ones find them listed.
+RULE_MODES = {
+    "default": {},
+    "batch": {"batch_searches": True},
+    "composite": {"composite_rules": True},
+    "incremental": {"incremental_rules": True},
+}
+REASONS = ("Too many requests", "Too much traffic", "Manually blocked", "Scanning for vulnerabilities")
+BENCH_RULES = [
+    ("Too many requests (12h)", "requests", 90000, "12h", ""),
+    ("Too many requests (1h)", "requests", 95000, "1h", ""),
+    ("Too much traffic", "bytes", 190000000, "12h", ""),
+    ("Too many POSTs", "requests", 80000, "12h", "request_method == POST"),
+    ("Scanning for PHP", "requests", 98000, "24h", "uri ~= .*\\.php"),
+]
+
+# Each entry takes up this many addresses, so every /32 or /128 entry has room for a /28 or /124 in its place
+ENTRY_SPAN = 16
+NETWORKS = {
+    # IP version: (block list base, allow list base, base for additions, bits)
+    4: ("11.0.0.0", "12.0.0.0", "13.0.0.0", 32),
+    6: ("2001:db8::", "2001:db9::", "2001:dba::", 128),
+}
+
+
+class FakeRequest:
+    def __init__(self, method: str = "GET", headers: dict = None):
+        self.method = method
+        self.headers = headers or {}
+        self.path = "/"
+
+
+def address(version: int, base: str, offset: int) -> str:
+    family = plugins.lists.ADDRESS_FAMILIES[version]
+    bits = NETWORKS[version][3]
+    value = int.from_bytes(socket.inet_pton(family, base), "big") + offset
+    return socket.inet_ntop(family, value.to_bytes(bits // 8, "big"))
+
+
+def synthetic_ip(version: int, base: str, i: int) -> str:
+    """Returns the i'th synthetic entry: mostly single addresses, with every tenth one a small network instead"""
+    bits = NETWORKS[version][3]
+    ip = address(version, base, i * ENTRY_SPAN)
+    return f"{ip}/{bits - 4}" if i % 10 == 0 else ip
+
+
+def fill_lists(config: plugins.configuration.BlockyConfiguration, version: int, size: int, rng: random.Random):
+    """Writes synthetic block and allow lists straight to the database, as a restart would find them"""
+    block_base, allow_base, _add_base, _bits = NETWORKS[version]
+    now = int(time.time())
+
+    def rows(list_type: str, base: str, count: int) -> typing.Iterator[tuple]:
+        for i in range(count):
+            expires = -1 if i % 3 == 0 else now + rng.randint(3600, 180 * 86400)
+            host = f"host-{i % 20}" if i % 50 == 0 else "*"
+            timestamp = now - rng.randint(0, 86400 * 90)
+            ip = synthetic_ip(version, base, i)
+            columns = plugins.lists.IPEntry(ip, timestamp, expires).network_columns()
+            yield (
+                list_type, ip, rng.choice(REASONS), timestamp, expires, host,
+                columns["net_start"], columns["net_end"], columns["net_prefix"],
+            )
+
+    statement = (
+        "INSERT INTO lists (type, ip, reason, timestamp, expires, host, net_start, net_end, net_prefix) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    with config.sqlite.lock:
+        config.sqlite.cursor.execute("BEGIN")
+        config.sqlite.cursor.executemany(statement, rows("block", block_base, size))
+        config.sqlite.cursor.executemany(statement, rows("allow", allow_base, max(1, size // 10)))
+        config.sqlite.cursor.execute("COMMIT")
+
+
+def fill_rules(config: plugins.configuration.BlockyConfiguration):
+    for description, aggtype, limit, duration, filters in BENCH_RULES:
+        config.sqlite.insert(
+            "rules",
+            {"description": description, "aggtype": aggtype, "limit": limit, "duration": duration, "filters": filters},
+        )
+    config.sqlite.flush()
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.results: typing.List[dict] = []
+        self.failures: typing.List[str] = []  # Checks that did not hold, which make the run exit with an error
+
+    def record(self, name: str, size: int, version: int, seconds: float, operations: int = 1, **extra):
+        result = {
+            "name": name,
+            "size": size,
+            "version": version,
+            "seconds": round(seconds, 6),
+            "operations": operations,
+            "per_operation": round(seconds / operations, 9),
+        }
+        result.update(extra)
+        self.results.append(result)
+        per_operation = seconds / operations * 1000
+        print(f"{name:<28} {size:>8} v{version}  {seconds:10.4f}s  {per_operation:10.4f}ms/op", file=sys.stderr)
+
+    async def timed(self, name: str, size: int, version: int, coroutine: typing.Awaitable, operations: int = 1):
+        started = time.perf_counter()
+        result = await coroutine
+        self.record(name, size, version, time.perf_counter() - started, operations)
+        return result
+
+    def make_config(self, directory: str) -> plugins.configuration.BlockyConfiguration:
+        yml = {
+            "database": os.path.join(directory, "blocky.sqlite"),
+            "elasticsearch_url": "http://localhost:9200/",
+        }
+        config = plugins.configuration.BlockyConfiguration(yml)
+        config.elasticsearch = benchmarks.fake_es.FakeElasticsearch(
+            clients=self.args.clients, latency=self.args.latency, jitter=self.args.jitter
+        )
+        return config
+
+    def bench_lists(self, config: plugins.configuration.BlockyConfiguration, size: int, version: int):
+        started = time.perf_counter()
+        config.block_list = plugins.lists.List(config, "block")
+        config.allow_list = plugins.lists.List(config, "allow")
+        self.record("list_init", size, version, time.perf_counter() - started, memory_kb=max_rss_kb())
+
+        # Additions that pass the conflict checks, and ones that are refused by them
+        _block_base, _allow_base, add_base, bits = NETWORKS[version]
+        now = int(time.time())
+        started = time.perf_counter()
+        for i in range(ADD_OPERATIONS):
+            config.block_list.add(address(version, add_base, i), timestamp=now, reason="Benchmark", host="*")
+        self.record("list_add", size, version, time.perf_counter() - started, ADD_OPERATIONS)
+        block_base = NETWORKS[version][0]
+        started = time.perf_counter()
+        for i in range(ADD_OPERATIONS):
+            try:
+                ip = synthetic_ip(version, block_base, i % size)
+                config.block_list.add(ip, timestamp=now, reason="Conflict", host="*")
+            except plugins.lists.BlockListException:
+                pass
+        self.record("list_add_conflict", size, version, time.perf_counter() - started, ADD_OPERATIONS)
+        started = time.perf_counter()
+        config.sqlite.flush()
+        self.record("sqlite_flush", size, version, time.perf_counter() - started)
+
+    async def bench_cycles(self, config: plugins.configuration.BlockyConfiguration, size: int, version: int):
+        # A cycle should only queue its writes (bans, santa's list, audit log), for the flush that follows it to
+        # commit in one go, so count the transactions committed during each cycle
+        commits = []
+
+        def trace(statement: str):
+            if statement == "COMMIT":
+                commits.append(statement)
+
+        config.sqlite.connector.set_trace_callback(trace)
+        for mode, settings in RULE_MODES.items():
+            for key, value in settings.items():
+                setattr(config, key, value)
+            runner = plugins.background.RuleRunner(config)
+            for cycle in range(RUN_CYCLES):
+                commits.clear()
+                blocked = plugins.background.OFFENDERS_BLOCKED.values.get((), 0)
+                await self.timed(f"run_cycle_{mode}_{cycle + 1}", size, version, runner.run_cycle())
+                self.results[-1]["commits"] = len(commits)
+                self.results[-1]["blocked"] = plugins.background.OFFENDERS_BLOCKED.values.get((), 0) - blocked
+                if commits:
+                    self.failures.append(f"run_cycle_{mode}_{cycle + 1} committed {len(commits)} transaction(s)")
+            await config.db.flush()
+            for key in settings:
+                setattr(config, key, False)
+        config.sqlite.connector.set_trace_callback(None)
+
+    async def bench_endpoints(self, config: plugins.configuration.BlockyConfiguration, size: int, version: int):
+        all_endpoint = importlib.import_module("endpoints.all")
+        search_endpoint = importlib.import_module("endpoints.search")
+        upload_endpoint = importlib.import_module("endpoints.upload")
+
+        async def fetch_all(formdata: dict):
+            output = await all_endpoint.process(config, FakeRequest(), formdata)
+            if isinstance(output, dict):  # ahapi serializes these
+                json.dumps(output, indent=2)
+
+        await self.timed("all", size, version, fetch_all({}))
+        await self.timed("all_cached", size, version, fetch_all({}))
+        await self.timed("all_page", size, version, fetch_all({"type": "block", "limit": "1000"}))
+
+        block_base = NETWORKS[version][0]
+        rng = random.Random(size)
+        sources = [address(version, block_base, rng.randrange(size) * ENTRY_SPAN) for _ in range(SEARCH_OPERATIONS)]
+
+        async def search():
+            for source in sources:
+                await search_endpoint.process(config, FakeRequest(), {"source": source})
+
+        await self.timed("search", size, version, search(), SEARCH_OPERATIONS)
+
+        rules = [
+            {"source": synthetic_ip(version, block_base, i), "target": "DROP", "chain": "INPUT", "line": str(i)}
+            for i in range(UPLOAD_RULES)
+        ]
+
+        async def upload(iptables: typing.List[dict]):
+            await upload_endpoint.process(config, FakeRequest("POST"), {"hostname": "bench", "iptables": iptables})
+
+        await self.timed("upload", size, version, upload(rules))
+        await self.timed("upload_unchanged", size, version, upload(rules))
+        await self.timed("upload_changed", size, version, upload(rules[1:]))
+
+    async def run_one(self, size: int, version: int):
+        directory = tempfile.mkdtemp(prefix="blocky-bench-")
+        try:
+            config = self.make_config(directory)
+            fill_lists(config, version, size, random.Random(size))
+            fill_rules(config)
+            self.bench_lists(config, size, version)
+            await self.bench_cycles(config, size, version)
+            await self.bench_endpoints(config, size, version)
+            config.db.writer.shutdown()
+            config.db.readers.shutdown()
+            # Do the shutdown work of the atexit hooks now, while the database is still open, and drop the hooks,
+            # which would otherwise run against a closed connection (and keep every run's config alive until exit)
+            config.changelog.release()
+            config.sqlite.flush()
+            atexit.unregister(config.changelog.release)
+            atexit.unregister(config.sqlite.flush)
+            config.sqlite.connector.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        gc.collect()
+
+    async def run(self):
+        for size in self.args.sizes:
+            for version in self.args.families:
+                await self.run_one(size, version)
+
+
+def max_rss_kb() -> typing.Optional[int]:
+    """Returns the peak memory use of the process so far, where the platform can tell"""
+    try:
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss // 1024 if sys.platform == "darwin" else rss  # macOS reports bytes, Linux kilobytes
+    except ImportError:
+        return None
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the Blocky/4 benchmarks and writes the results as JSON")
+    parser.add_argument("--sizes", default=",".join(str(x) for x in DEFAULT_SIZES), help="Block list sizes to test")
+    parser.add_argument("--families", default=",".join(str(x) for x in DEFAULT_FAMILIES), help="IP versions to test")
+    parser.add_argument("--clients", type=int, default=10000, help="Number of distinct clients the fake ES knows of")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds the fake ES takes per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds per ES request")
+    parser.add_argument("--output", help="File to write the results to, instead of standard output")
+    args = parser.parse_args()
+    args.sizes = [int(x) for x in args.sizes.split(",")]
+    args.families = [int(x) for x in args.families.split(",")]
+    assert all(version in NETWORKS for version in args.families), "IP versions must be 4 and/or 6"
+
+    bench = Bench(args)
+    asyncio.run(bench.run())
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": int(time.time()),
+        "settings": {"clients": args.clients, "latency": args.latency, "jitter": args.jitter},
+        "results": bench.results,
+        "failures": bench.failures,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    for failure in bench.failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    if bench.failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,31 +15,150 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import aiohttp.web
 import ahapi
+import base64
+import binascii
+import itertools
+import json
+import plugins.caching
 import plugins.configuration
-import operator
+import plugins.lists
+import typing
 
 """ block/allow list viewing endpoint for Blocky/4"""
 
+SHORT_LIST_LENGTH = 25  # Number of entries to show in short lists (front page)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500  # Number of NDJSON lines written per chunk when streaming
+PAGING_PARAMETERS = ("type", "limit", "after", "sort", "host", "reason", "expires_after", "expires_before", "format")
 
-async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
-    short = formdata.get('short', False)
-    allow_items = [x for x in state.allow_list]
-    block_items = [x for x in state.block_list]
-    total_blocks = len(block_items)
-    total_allows = len(allow_items)
-    if short:  # For not showing all 27482487 items, for front page
-        if short in ["block", "all", "true"]:
-            block_items = sorted(block_items, reverse=True, key=operator.itemgetter("timestamp"))[:25]
-        if short in ["allow", "all", "true"]:
-            allow_items = sorted(allow_items, reverse=True, key=operator.itemgetter("timestamp"))[:25]
+
+def parse_cursor(field: str, cursor: str) -> tuple:
+    """Parses a paging cursor, as found in the "next" field of a page, back into a sort key for the given field"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (UnicodeError, binascii.Error, json.JSONDecodeError):
+        raise ValueError("Malformed paging cursor")
+    # The network part of the key is (version, start, prefix), preceded by the sort field unless sorting by IP
+    length = 3 if field == "ip" else 4
+    assert isinstance(key, list) and len(key) == length, f"Paging cursor does not match sort field {field}"
+    for position, x in enumerate(key):
+        types = (int, float) if position < length - 3 else int
+        assert isinstance(x, types) and not isinstance(x, bool), "Malformed paging cursor"
+    return tuple(key)
+
+
+def make_cursor(field: str, entry: plugins.lists.IPEntry) -> str:
+    """Encodes an entry's sort key as a paging cursor. JSON keeps the types of its parts, such as float expiry times."""
+    key = json.dumps(plugins.lists.sort_key(field, entry), separators=(",", ":"))
+    return base64.urlsafe_b64encode(key.encode("ascii")).decode("ascii")
+
+
+def make_filter(formdata: dict) -> typing.Callable[[plugins.lists.IPEntry], bool]:
+    """Builds a filter for entries from the host, reason (substring) and expiry range parameters.
+    Entries that never expire count as expiring after any given time."""
+    host = formdata.get("host")
+    reason = formdata.get("reason", "").lower()
+    expires_after = int(formdata["expires_after"]) if formdata.get("expires_after") else None
+    expires_before = int(formdata["expires_before"]) if formdata.get("expires_before") else None
+
+    def matches(entry: plugins.lists.IPEntry) -> bool:
+        if host and entry.host != host:
+            return False
+        if reason and reason not in (entry.reason or "").lower():
+            return False
+        if expires_after is not None and entry.expires != -1 and entry.expires <= expires_after:
+            return False
+        if expires_before is not None and (entry.expires == -1 or entry.expires >= expires_before):
+            return False
+        return True
+
+    return matches
+
+
+async def stream_entries(entries: typing.Iterator[plugins.lists.IPEntry]) -> typing.AsyncIterator[bytes]:
+    """Serializes entries as NDJSON, a chunk at a time, so the full document never has to exist in memory"""
+    lines = []
+    for entry in entries:
+        lines.append(json.dumps(entry.to_dict()))
+        if len(lines) == STREAM_CHUNK_SIZE:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def list_page(state: plugins.configuration.BlockyConfiguration, formdata: dict):
+    """Returns a page of entries from a single list, or streams them all as NDJSON if format=ndjson"""
+    list_type = formdata.get("type", "block")
+    entry_list = {"block": state.block_list, "allow": state.allow_list}.get(list_type)
+    sort = formdata.get("sort", "-timestamp")
+    field = sort.lstrip("-")
+    stream = formdata.get("format") == "ndjson"
+    try:
+        assert entry_list is not None, f"Unknown list type: {list_type}"
+        assert field in plugins.lists.SORT_FIELDS, f"Cannot sort by {field}"
+        limit = int(formdata.get("limit", 0 if stream else DEFAULT_PAGE_SIZE))
+        if stream:
+            assert limit >= 0, "Limit cannot be negative"  # 0 means no limit, for streaming only
+        else:
+            assert 1 <= limit <= MAX_PAGE_SIZE, f"Page size must be between 1 and {MAX_PAGE_SIZE}"
+        after = parse_cursor(field, formdata["after"]) if formdata.get("after") else None
+        matches = make_filter(formdata)
+    except (AssertionError, ValueError) as e:
+        return aiohttp.web.json_response(
+            {"success": False, "status": "invalid", "message": f"Invalid request: {e}"}, status=400
+        )
+
+    # Streaming hands control back to the event loop as it goes, so it walks a copy of the current order
+    entries = entry_list.ordered(field)
+    if stream:
+        entries = list(entries)
+    found = filter(matches, entry_list.walk(field, sort.startswith("-"), after, entries))
+
+    if stream:
+        if limit:
+            found = itertools.islice(found, limit)
+        return aiohttp.web.Response(status=200, content_type="application/x-ndjson", body=stream_entries(found))
+
+    page = list(itertools.islice(found, limit))
     return {
-        "total_block": total_blocks,
-        "total_allow": total_allows,
-        "allow": allow_items,
-        "block": block_items,
+        "type": list_type,
+        "total": len(entry_list),
+        "sort": sort,
+        "entries": [entry.to_dict() for entry in page],
+        # A full page means there may be more; the last page is the first one that comes back short
+        "next": make_cursor(field, page[-1]) if len(page) == limit else None,
     }
 
 
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict):
+    # Paging through a single list, optionally filtered, sorted or streamed
+    if any(parameter in formdata for parameter in PAGING_PARAMETERS):
+        return await list_page(state, formdata)
+
+    # Both lists in one document, as used by the front page (short) and older clients (everything)
+    short = formdata.get('short', False)
+    # For not showing all 27482487 items, for front page
+    block_limit = SHORT_LIST_LENGTH if short in ["block", "all", "true"] else 0
+    allow_limit = SHORT_LIST_LENGTH if short in ["allow", "all", "true"] else 0
+
+    # Lists only change when their version does, so the versions (and which variant) make for a strong ETag
+    etag = plugins.caching.make_etag(state.block_list.version, state.allow_list.version, block_limit, allow_limit)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if plugins.caching.etag_matches(request, etag):
+        return aiohttp.web.Response(status=304, headers=headers)
+
+    body = '{"total_block": %u, "total_allow": %u, "allow": %s, "block": %s}' % (
+        len(state.block_list),
+        len(state.allow_list),
+        state.allow_list.snapshot(allow_limit),
+        state.block_list.snapshot(block_limit),
+    )
+    return aiohttp.web.Response(status=200, headers=headers, content_type="application/json", text=body)
+
+
 def register(config: plugins.configuration.BlockyConfiguration):
     return ahapi.endpoint(process)
@@ -41,10 +41,10 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
         # All good!
         return {"success": True, "status": "allowed", "message": f"IP {ip} added to allow list"}
     elif request.method == "DELETE":
-        for entry in state.allow_list:
-            if entry['ip'] == ip:
-                state.allow_list.remove(entry)
-                return {"success": True, "status": "removed", "message": f"IP {ip} removed from allow list"}
+        entry = state.allow_list.get(ip)
+        if entry:
+            state.allow_list.remove(entry)
+            return {"success": True, "status": "removed", "message": f"IP {ip} removed from allow list"}
         return {"success": False, "status": "not found", "message": f"IP {ip} does not exist in the allow list"}
 
 
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiohttp.web
+import ahapi
+import json
+import plugins.configuration
+import typing
+
+""" Audit log query endpoint for Blocky/4, streaming entries from both the database and the archives as NDJSON"""
+
+
+async def stream_rows(chunks: typing.AsyncGenerator[typing.List[dict], None]) -> typing.AsyncIterator[bytes]:
+    try:
+        async for chunk in chunks:
+            yield "".join(json.dumps(row) + "\n" for row in chunk).encode("utf-8")
+    finally:
+        await chunks.aclose()  # Ends the query right away, rather than whenever it is garbage collected
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict):
+    try:
+        ip = formdata.get("ip")
+        since = int(formdata.get("since", 0))
+        until = int(formdata["until"]) if formdata.get("until") else None
+        limit = int(formdata.get("limit", 0))
+        assert limit >= 0, "Limit cannot be negative"  # 0 means no limit
+    except (AssertionError, ValueError) as e:
+        return {"success": False, "status": "invalid", "message": f"Invalid request: {e}"}
+    rows = state.auditlog.query(ip=ip, since=since, until=until, limit=limit)
+    return aiohttp.web.Response(status=200, content_type="application/x-ndjson", body=stream_rows(rows))
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
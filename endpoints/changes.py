@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ahapi
+import plugins.configuration
+
+""" Delta sync endpoint for Blocky/4: list changes since a given sequence number"""
+
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict) -> dict:
+    try:
+        since = int(formdata.get("since", 0))
+        limit = int(formdata.get("limit", DEFAULT_LIMIT))
+        assert 1 <= limit <= MAX_LIMIT, f"Limit must be between 1 and {MAX_LIMIT}"
+    except (AssertionError, ValueError) as e:
+        return {"success": False, "status": "invalid", "message": f"Invalid request: {e}"}
+    host = formdata.get("host")
+    hosts = {plugins.configuration.DEFAULT_HOST_BLOCK, host}
+
+    changes = state.changelog.since(since)
+    if changes is None:
+        # The client is too far behind (or ahead, from before a database reset). It should fetch the full lists,
+        # then carry on from the sequence number given here. Re-applying changes made in between is harmless.
+        return {
+            "success": False,
+            "status": "resync",
+            "resync": True,
+            "sequence": state.changelog.seq,
+            "message": f"Changes since {since} are no longer available, please fetch the full lists",
+        }
+
+    found = []
+    sequence = since
+    for change in changes:
+        if len(found) >= limit:
+            break
+        sequence = change.seq
+        if not host or change.entry.host in hosts:
+            found.append(change.to_dict())
+    return {
+        "success": True,
+        "resync": False,
+        "sequence": sequence,  # Use this as $since for the next request
+        "more": sequence < state.changelog.seq,
+        "changes": found,
+    }
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
@@ -40,8 +40,9 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
         if not (len(email_parsed) == 2 and '@' in email_parsed[1]):
             return aiohttp.web.Response(status=400, text=f"Invalid email address specified: {email_address}")
         my_ip = request.headers["x-forwarded-for"]
-        entry = state.sqlite.fetchone("santalist", ip=my_ip)    # Santa list entry for tokens
-        block_entry = state.sqlite.fetchone("lists", ip=my_ip, type="block")  # Actual block list entry, does it exist or is this request in vain?
+        await state.santa_list.load([my_ip])
+        entry = state.santa_list.get(my_ip)    # Santa list entry for tokens
+        block_entry = await state.db.fetchone("lists", ip=my_ip, type="block")  # Actual block list entry, does it exist or is this request in vain?
         if entry and block_entry and email_address:
             last_attempt = pending_unblocks.get(my_ip, 0)
             if last_attempt < (time.time() - RATE_LIMIT):
@@ -59,14 +60,14 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
                 
     if token:
         my_ip = request.headers["x-forwarded-for"]
-        entry = state.sqlite.fetchone("santalist", token=token)
+        entry = await state.db.fetchone("santalist", token=token)
         if entry:
             if entry["ip"] == my_ip:
                 if entry["niceness"] >= -1:  # If >= -1, they can unblock themselves
                     now = int(time.time())
                     expires = now + 600  # now + 10 min
                     entry["token"] = str(uuid.uuid4())  # Moon Healing Escalation....REFRESH! (so they can't use it again)
-                    state.sqlite.update("santalist", entry, ip=my_ip)  # Update santa's list db with new token
+                    state.santa_list.save(entry)  # Update santa's list db with new token
                     state.allow_list.add(ip=my_ip, expires=expires, reason="Temporary soft-allowlisted to unblock, through self-serve UI.", host="*", force=True)
                     return aiohttp.web.Response(status=200, text=f"Successfully unblocked IP {my_ip}")
                 return aiohttp.web.Response(status=422, text="You cannot automatically unblock this IP address due to its infraction count. Please contact abuse@infra.apache.org instead.")
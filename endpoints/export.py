@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiohttp.web
+import ahapi
+import plugins.blockset
+import plugins.caching
+import plugins.configuration
+import re
+
+""" Per-host block set export endpoint for Blocky/4, as ipset or nftables restore files"""
+
+DEFAULT_SET_NAME = "blocky4"
+VALID_SET_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]{0,27}$")  # ipset limits names to 31 characters, incl. "-v6"
+VALID_HOST = re.compile(r"^[A-Za-z0-9*._-]+$")
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict):
+    host = formdata.get("host", plugins.configuration.DEFAULT_HOST_BLOCK)
+    output_format = formdata.get("format", "ipset")
+    name = formdata.get("name", DEFAULT_SET_NAME)
+    if output_format not in plugins.blockset.FORMATS:
+        return {"success": False, "status": "invalid", "message": f"Unknown export format: {output_format}"}
+    if not VALID_HOST.match(host) or not VALID_SET_NAME.match(name):
+        return {"success": False, "status": "invalid", "message": "Invalid host or set name"}
+
+    # Only the lists themselves can change the output for a given URL, so their versions make for a strong ETag
+    etag = plugins.caching.make_etag(state.block_list.version, state.allow_list.version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if plugins.caching.etag_matches(request, etag):
+        return aiohttp.web.Response(status=304, headers=headers)
+    text = state.blocksets.get(host, output_format, name)
+    return aiohttp.web.Response(status=200, headers=headers, content_type="text/plain", text=text)
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
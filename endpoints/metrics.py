@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiohttp.web
+import ahapi
+import plugins.configuration
+import plugins.metrics
+
+""" Prometheus metrics endpoint for Blocky/4"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Sizes of things are read off the state when scraped, rather than tracked on every change
+LIST_ENTRIES = plugins.metrics.gauge("blocky_list_entries", "Entries on a list", ("list",))
+EXPIRY_SCHEDULED = plugins.metrics.gauge("blocky_expiry_scheduled", "Items in the expiry heap, stale ones included")
+IPTABLES_HOSTS = plugins.metrics.gauge("blocky_iptables_hosts", "Client hosts with uploaded iptables rules")
+IPTABLES_RULES = plugins.metrics.gauge("blocky_iptables_rules", "Uploaded iptables rules, across all hosts")
+SQLITE_PENDING = plugins.metrics.gauge("blocky_sqlite_pending_statements", "Writes queued for the next flush")
+CHANGELOG_SEQUENCE = plugins.metrics.gauge("blocky_changelog_sequence", "Sequence number of the latest list change")
+PUBSUB_QUEUED = plugins.metrics.gauge("blocky_pubsub_queued", "List additions waiting to be published")
+# Counted by the state as they happen, and carried over into the counter when scraped
+ES_REQUESTS = plugins.metrics.counter("blocky_es_requests_total", "Requests made to ElasticSearch")
+
+
+async def process(state: plugins.configuration.BlockyConfiguration, request, formdata: dict):
+    for entry_list in (state.block_list, state.allow_list):
+        LIST_ENTRIES.set(len(entry_list), list=entry_list.type)
+    EXPIRY_SCHEDULED.set(len(state.expiry.heap))
+    IPTABLES_HOSTS.set(len(state.client_iptables.hosts))
+    IPTABLES_RULES.set(len(state.client_iptables))
+    SQLITE_PENDING.set(len(state.sqlite.pending))
+    CHANGELOG_SEQUENCE.set(state.changelog.seq)
+    PUBSUB_QUEUED.set(state.publisher.stats()["queued"] if state.publisher else 0)
+    ES_REQUESTS.inc(state.es_requests - ES_REQUESTS.values.get((), 0))
+    return aiohttp.web.Response(
+        status=200, headers={"Content-Type": CONTENT_TYPE}, body=plugins.metrics.REGISTRY.render().encode("utf-8")
+    )
+
+
+def register(config: plugins.configuration.BlockyConfiguration):
+    return ahapi.endpoint(process)
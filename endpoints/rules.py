@@ -43,15 +43,15 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
 
     # Fetching rules?
     if request.method == "GET":
-        rules = [x for x in state.sqlite.fetch("rules", limit=0)]
+        rules = await state.db.fetch("rules", limit=0)
         return rules
 
     # Removing a rule?
     if request.method == "DELETE":
         rule_id = formdata.get("rule", -1)
-        rule = state.sqlite.fetchone("rules", id=rule_id)
+        rule = await state.db.fetchone("rules", id=rule_id)
         if rule:
-            state.sqlite.delete("rules", id=rule_id)
+            await state.db.delete("rules", id=rule_id)
             return {"success": True, "status": "deleted", "message": f"Rule #{rule_id} has been deleted."}
         else:
             return {"success": False, "status": "not found", "message": f"Rule #{rule_id} does not exist."}
@@ -86,7 +86,7 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
             "filters": filters,
         }
         # Check for duplicates first
-        entry_inserted = state.sqlite.fetchone("rules", **entry)
+        entry_inserted = await state.db.fetchone("rules", **entry)
         if entry_inserted:
             return {
                 "success": False,
@@ -95,8 +95,8 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
             }
 
         # Insert and return the ID it got
-        state.sqlite.insert("rules", entry)
-        entry_inserted = state.sqlite.fetchone("rules", **entry)
+        await state.db.insert("rules", entry)
+        entry_inserted = await state.db.fetchone("rules", **entry)
         return {"success": True, "status": "added", "message": f"Rule #{entry_inserted['id']} has been added"}
 
     # Patching a rule?
@@ -130,12 +130,12 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
             "filters": filters,
         }
         # Check that rule exists
-        existing_entry = state.sqlite.fetchone("rules", id=rule_id)
+        existing_entry = await state.db.fetchone("rules", id=rule_id)
         if not existing_entry:
             return {"success": False, "status": "not found", "message": f"Rule #{rule_id} does not exist"}
 
         # Upsert rule
-        state.sqlite.upsert("rules", entry, id=rule_id)
+        await state.db.upsert("rules", entry, id=rule_id)
         return {"success": True, "status": "modified", "message": f"Rule #{rule_id} has been modified"}
 
 
@@ -39,29 +39,13 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
     results = {"allow": [], "block": [], "iptables": []}
 
     # Search allow list
-    for entry in state.allow_list:
-        if entry.network in as_net or as_net in entry.network:
-            results["allow"].append(entry)
+    results["allow"] = [x.to_dict() for x in state.allow_list.overlapping(as_net)]
 
     # Search block list
-    for entry in state.block_list:
-        if entry.network in as_net or as_net in entry.network:
-            results["block"].append(entry)
+    results["block"] = [x.to_dict() for x in state.block_list.overlapping(as_net)]
 
-    # Search iptables (max 50-ish records)
-    now = time.time()
-    for hostname, entry in state.client_iptables.items():
-        timestamp, iptables = entry
-        if timestamp > now - 86400:  # Don't wanna fetch machines that have been offline for more than a day
-            for rule in iptables:
-                if rule["as_net"] in as_net or as_net in rule["as_net"]:
-                    x_rule = dict(rule)
-                    del x_rule["as_net"]  # Can't serialize
-                    results["iptables"].append(x_rule)
-                    if len(results["iptables"]) >= MAX_IPTABLES_RECORDS:
-                        break
-        if len(results["iptables"]) >= MAX_IPTABLES_RECORDS:
-            break
+    # Search iptables, skipping machines that have been offline for more than a day
+    results["iptables"] = state.client_iptables.search(as_net, now, MAX_IPTABLES_RECORDS)
 
     # All good!
     return results
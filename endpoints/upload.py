@@ -27,15 +27,23 @@ async def process(state: plugins.configuration.BlockyConfiguration, request, for
     now = int(time.time())
     hostname = formdata.get("hostname")
     assert hostname, "Hostname entry cannot be empty!"
+    digest = formdata.get("digest")  # Clients may send a digest of their rules, and leave the rules out if unchanged
     iptables = formdata.get("iptables")
+    if digest and iptables is None:
+        if state.client_iptables.refresh(hostname, now, digest):
+            return {"success": True, "status": "unchanged", "message": f"iptable data for {hostname} is unchanged."}
+        return {
+            "success": False,
+            "status": "unknown",
+            "message": f"No iptable data matching this digest for {hostname}, please upload in full.",
+        }
     assert isinstance(iptables, list), "IPTables entry must be a list of rules"
 
-    # Set in-memory data, no sqlite here.
-    for entry in iptables:
-        assert "source" in entry, "Each iptables entry must have a source address!"
-        entry["as_net"] = netaddr.IPNetwork(entry["source"])
-        entry["hostname"] = hostname
-    state.client_iptables[hostname] = (now, iptables)
+    # Set in-memory data, no sqlite here. Unchanged uploads only refresh the timestamp of the host's data.
+    try:
+        state.client_iptables.replace(hostname, now, iptables, digest)
+    except netaddr.core.AddrFormatError as e:
+        return {"success": False, "status": "invalid", "message": f"Address parsing error: {e}"}
 
     # All good!
     return {"success": True, "status": "saved", "message": f"iptable data for {hostname} has been saved."}
@@ -22,13 +22,22 @@ import asyncio
 import yaml
 import plugins.configuration
 import plugins.background
+import plugins.metrics
+import plugins.storage
 import ahapi
+import signal
+import sys
 
 
 async def main(loop: asyncio.BaseEventLoop):
     yml = yaml.safe_load(open("blocky4.yaml", "r"))
     config = plugins.configuration.BlockyConfiguration(yml)
     loop.create_task(plugins.background.run(config))
+    loop.create_task(config.expiry.run())
+    loop.create_task(config.auditlog.run())
+    if config.publisher:
+        loop.create_task(config.publisher.run())
+    loop.create_task(plugins.storage.run(config.db, config.sqlite_flush_interval))
     httpserver = ahapi.simple(
         static_dir="webui",
         bind_ip=config.http_ip,
@@ -36,11 +45,15 @@ async def main(loop: asyncio.BaseEventLoop):
         state=config,
         max_upload=4 * 1024 * 1024,  # 4MB ≃ 20,000 iptables entries from a client
     )
+    # Record latency and outcome of every API endpoint
+    for name, endpoint in httpserver.handlers.items():
+        endpoint.exec = plugins.metrics.instrument(name, endpoint.exec)
     loop.create_task(httpserver.loop())
     while True:
         await asyncio.sleep(10)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))  # Exit cleanly, so queued database writes get flushed
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main(loop))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import calendar
+import gzip
+import json
+import os
+import re
+import time
+import typing
+import plugins.configuration
+import plugins.metrics
+import plugins.storage
+
+""" Audit log retention: moving old audit log rows into monthly, compressed archive files, and reading them back """
+
+ARCHIVE_NAME = "auditlog-{month}.ndjson.gz"  # One archive per month (UTC), as gzipped NDJSON
+ARCHIVE_PATTERN = re.compile(r"^auditlog-(\d{4})-(\d{2})\.ndjson\.gz$")
+ARCHIVE_INTERVAL = 3600  # Seconds between looking for rows to archive, once everything due has been archived
+BATCH_PAUSE = 0.1  # Seconds between archiving batches, so a large backlog never hogs the writer thread
+QUERY_PAUSE = 5  # Seconds to wait before trying again, when archiving is paused by running queries
+READ_CHUNK_SIZE = 1000  # Rows read at a time when streaming query results
+
+AUDIT_ARCHIVED = plugins.metrics.counter("blocky_audit_archived_total", "Audit log rows moved to the archives")
+
+Row = typing.Dict[str, typing.Any]  # id, ip, event and timestamp of an audit log row
+
+
+def archive_month(timestamp: int) -> str:
+    return time.strftime("%Y-%m", time.gmtime(timestamp))
+
+
+def month_start(month: str) -> int:
+    """Returns the (UTC) epoch at which a YYYY-MM month starts"""
+    year, month_number = (int(x) for x in month.split("-"))
+    return calendar.timegm((year, month_number, 1, 0, 0, 0))
+
+
+def next_month(month: str) -> str:
+    year, month_number = (int(x) for x in month.split("-"))
+    return f"{year + month_number // 12:04}-{month_number % 12 + 1:02}"
+
+
+def matches(row: Row, ip: typing.Optional[str], since: int, until: typing.Optional[int]) -> bool:
+    if ip and row["ip"] != ip:
+        return False
+    return row["timestamp"] >= since and (until is None or row["timestamp"] < until)
+
+
+class AuditLog:
+    """Keeps the auditlog table down to the past $retention days. Older rows are appended to one gzipped NDJSON
+    archive per month and then deleted, a batch at a time on the database writer thread, so neither the event loop
+    nor other writes are held up for long. Appending to an archive adds a gzip member to it, which gzip readers
+    see as one continuous file. Rows are written to their archive before they are deleted, so a crash in between
+    can only lead to a batch being archived twice, never to rows being lost.
+
+    Queries stream matching rows from the archives first and the live table after, oldest first. Archiving is
+    paused while any query runs, so no row can move from the table to an archive behind a query's back."""
+
+    def __init__(self, state: "plugins.configuration.BlockyConfiguration", yml: dict):
+        self.state = state
+        self.retention = int(yml.get("audit_retention", plugins.configuration.DEFAULT_AUDIT_RETENTION))
+        self.batch_size = int(yml.get("audit_batch_size", plugins.configuration.DEFAULT_AUDIT_BATCH_SIZE))
+        self.archive_dir = yml.get("audit_archive_dir", state.database_filepath + ".auditlog")
+        self.queries = 0  # Number of queries currently streaming
+        self.lock: typing.Optional[asyncio.Lock] = None  # Held while a batch is being archived, created by run()
+
+    def archive_path(self, month: str) -> str:
+        return os.path.join(self.archive_dir, ARCHIVE_NAME.format(month=month))
+
+    def archive_months(self) -> typing.List[str]:
+        """Returns the months that have an archive, oldest first"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        months = []
+        for filename in os.listdir(self.archive_dir):
+            match = ARCHIVE_PATTERN.match(filename)
+            if match:
+                months.append(f"{match.group(1)}-{match.group(2)}")
+        return sorted(months)
+
+    def archive_batch(self, db: "plugins.storage.BlockyDB", cutoff: int) -> int:
+        """Moves up to batch_size rows older than $cutoff to the archives. Runs on the writer thread.
+        Returns the number of rows moved."""
+        rows = db.query(
+            "SELECT id, ip, event, timestamp FROM auditlog WHERE timestamp < ? ORDER BY id LIMIT ?",
+            cutoff,
+            self.batch_size,
+        )
+        if not rows:
+            return 0
+        by_month: typing.Dict[str, typing.List[str]] = {}
+        for row in rows:
+            by_month.setdefault(archive_month(row["timestamp"]), []).append(json.dumps(dict(row)))
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for month, lines in by_month.items():
+            with open(self.archive_path(month), "ab") as f:
+                with gzip.GzipFile(fileobj=f, mode="wb") as archive:
+                    archive.write(("\n".join(lines) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+        with db.lock:
+            db.run(
+                "DELETE FROM auditlog WHERE id BETWEEN ? AND ? AND timestamp < ?", rows[0]["id"], rows[-1]["id"], cutoff
+            )
+        AUDIT_ARCHIVED.inc(len(rows))
+        return len(rows)
+
+    async def archive(self) -> int:
+        """Moves every row past the retention period to the archives, one batch at a time. Returns the number moved."""
+        cutoff = int(time.time()) - self.retention * 86400
+        moved = 0
+        while True:
+            async with self.lock:
+                paused = self.queries > 0
+                if not paused:
+                    batch = await self.state.db.run(lambda db: self.archive_batch(db, cutoff))
+            if paused:
+                await asyncio.sleep(QUERY_PAUSE)  # Carry on shortly, once the queries are done
+                continue
+            moved += batch
+            if batch < self.batch_size:
+                break
+            await asyncio.sleep(BATCH_PAUSE)
+        if moved:
+            print(f"Moved {moved} audit log entries older than {self.retention} days to {self.archive_dir}")
+        return moved
+
+    async def run(self):
+        self.lock = asyncio.Lock()
+        if not self.retention:
+            return  # Keeping everything in the database
+        while True:
+            await self.archive()
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    @staticmethod
+    def read_archive(path: str) -> typing.Iterator[Row]:
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as archive:
+                for line in archive:
+                    if line.strip():
+                        yield json.loads(line)
+        except EOFError:
+            print(f"Audit log archive {path} ends in an incomplete batch, skipping the rest of it")
+
+    async def query(
+        self, ip: str = None, since: int = 0, until: int = None, limit: int = 0
+    ) -> typing.AsyncIterator[typing.List[Row]]:
+        """Yields the audit log rows for an IP (or all of them) from $since up to $until, oldest first, in chunks.
+        Archives are read on a reader thread, and the live table is read in chunks by ID. Archiving stays paused
+        until the generator is exhausted or closed, so callers that may stop early should aclose() it when done."""
+        self.queries += 1
+        try:
+            if self.lock:
+                async with self.lock:  # Let a batch that is being archived right now finish first
+                    pass
+            remaining = limit or None
+            loop = asyncio.get_running_loop()
+            for month in self.archive_months():
+                if month_start(next_month(month)) <= since or (until is not None and month_start(month) >= until):
+                    continue
+                found = (row for row in self.read_archive(self.archive_path(month)) if matches(row, ip, since, until))
+                while remaining is None or remaining > 0:
+                    chunk_size = READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining)
+                    chunk = await loop.run_in_executor(
+                        self.state.db.readers, lambda: [row for _, row in zip(range(chunk_size), found)]
+                    )
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+
+            statement = "SELECT id, ip, event, timestamp FROM auditlog WHERE id > ? AND timestamp >= ?"
+            args = [since]
+            if until is not None:
+                statement += " AND timestamp < ?"
+                args.append(until)
+            if ip:
+                statement += " AND ip = ?"
+                args.append(ip)
+            statement += " ORDER BY id LIMIT ?"
+            last_id = -1
+            while remaining is None or remaining > 0:
+                chunk_size = READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining)
+                chunk = await self.state.db.query(statement, last_id, *args, chunk_size, table="auditlog")
+                if not chunk:
+                    break
+                last_id = chunk[-1]["id"]
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+                if len(chunk) < chunk_size:
+                    break
+        finally:
+            self.queries -= 1
@@ -19,6 +19,7 @@
 # Background worker - finds bans and adds 'em, and such and things
 
 import asyncio
+import re
 import elasticsearch_dsl
 import elasticsearch
 import typing
@@ -26,44 +27,69 @@ import netaddr
 import time
 import plugins.configuration
 import plugins.lists
-import datetime
+import plugins.metrics
+import plugins.window
 import uuid
 
 MAX_DB_DAYS = 3  # Only look backwards up to three days. No sense in involving every index in our search.
 CLIENT_IP_NAME = "client_ip"
 TIMESTAMP_NAME = "@timestamp"
+SEARCH_TIMEOUT = "30s"
+INCREMENTAL_MAX_CLIENTS = 10000  # Max number of distinct IPs to collect per time slice in incremental mode
+# Time slices spanning more than this many buckets are searched for per-IP totals instead of per-bucket counts, as
+# INCREMENTAL_MAX_CLIENTS times the number of buckets would otherwise run into ES's search.max_buckets (65,535)
+INCREMENTAL_MAX_SLICES = 5
+BACKFILL_CHUNKS = 12  # The first search of an incremental window is split over this many cycles
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
 
+ES_SEARCH_DURATION = plugins.metrics.histogram(
+    "blocky_es_search_duration_seconds", "Time taken by searches against ElasticSearch, by kind of search", ("query",)
+)
+CYCLE_DURATION = plugins.metrics.histogram("blocky_cycle_duration_seconds", "Time taken by a cycle of all ban rules")
+RULE_DURATION = plugins.metrics.histogram(
+    "blocky_rule_duration_seconds", "Time taken to search for the offenders of a ban rule", ("rule",)
+)
+RULE_OFFENDERS = plugins.metrics.counter(
+    "blocky_rule_offenders_total", "Offenders found by a ban rule, whether already listed or not", ("rule",)
+)
+RULE_FAILURES = plugins.metrics.counter(
+    "blocky_rule_failures_total",
+    "Ban rule searches that failed (error) or missed their deadline (timeout)",
+    ("rule", "reason"),
+)
+INCREMENTAL_FAILURES = plugins.metrics.counter(
+    "blocky_incremental_failures_total",
+    "Incremental searches whose time slice could not be added to the window, by phase (backfill or slice)",
+    ("phase",),
+)
+OFFENDERS_BLOCKED = plugins.metrics.counter("blocky_offenders_blocked_total", "Offenders added to the block list")
 
-async def find_top_clients(
+
+def parse_duration(duration: str) -> int:
+    """Converts a rule duration, such as 12h, 45m or 2d, into seconds"""
+    match = re.match(r"^(\d+)([dhms])", duration)
+    assert match, f"Invalid duration: {duration}"
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+AGGREGATION_NAMES = {"requests": "requests_per_ip", "bytes": "bytes_per_ip"}
+
+
+def build_search(
     config: plugins.configuration.BlockyConfiguration,
-    aggtype: typing.Literal["bytes", "requests"] = "requests",
     duration: str = "12h",
-    no_hits: int = 100,
     filters: typing.List[str] = None,
-) -> typing.List[typing.Tuple[str, int]]:
-    """Finds the top clients (IPs) in the database based on the parameters provided.
-    Searches for the top clients by either traffic volume (bytes) or requests."""
-    assert aggtype in ["bytes", "requests"], "Only by-bytes or by-requests aggregations are supported"
+    time_range: dict = None,
+) -> elasticsearch_dsl.Search:
+    """Builds the base search (time range and search filters) that top client aggregations are run against.
+    The time range defaults to the past $duration, but can be set explicitly with a range query dict."""
     if isinstance(filters, str):
         filters = [filters]
     elif filters is None:
         filters = []
 
     q = elasticsearch_dsl.Search(using=config.elasticsearch)
-    q = q.filter("range", **{TIMESTAMP_NAME: {"gte": f"now-{duration}"}})
-
-    # Make a list of the past three days' index names:
-    d = datetime.datetime.utcnow()
-    t = []
-    for i in range(0, MAX_DB_DAYS):
-        index_name = d.strftime(config.index_pattern)
-        has_index = await config.elasticsearch.indices.exists(index=index_name)
-        if has_index:
-            t.append(index_name)
-            d -= datetime.timedelta(days=1)
-    threes = ",".join(t)
-    if not threes:
-        return []
+    q = q.filter("range", **{TIMESTAMP_NAME: time_range or {"gte": f"now-{duration}"}})
 
     # Add all search filters
     for entry in filters:
@@ -81,21 +107,43 @@ async def find_top_clients(
                 q = xq("term", **{k: v})
             else:
                 raise TypeError(f"Unknown operator {o} in search filter: {entry}")
+    return q
+
+
+def add_top_clients_aggregation(
+    q: elasticsearch_dsl.Search,
+    aggtype: typing.Literal["bytes", "requests"] = "requests",
+    no_hits: int = 100,
+    limit: int = None,
+):
+    """Adds a named top-clients aggregation of the given type to a search.
+    If a limit is given, clients below it are left out by ES, using min_doc_count for requests and a
+    bucket_selector for bytes, so only actual offenders are sent back."""
+    assert aggtype in AGGREGATION_NAMES, "Only by-bytes or by-requests aggregations are supported"
     if aggtype == "requests":
-        q.aggs.bucket("requests_per_ip", elasticsearch_dsl.A("terms", field=f"{CLIENT_IP_NAME}.keyword", size=no_hits))
+        terms = {"field": f"{CLIENT_IP_NAME}.keyword", "size": no_hits}
+        if limit:
+            terms["min_doc_count"] = int(limit)
+        q.aggs.bucket(AGGREGATION_NAMES[aggtype], elasticsearch_dsl.A("terms", **terms))
     elif aggtype == "bytes":
-        q.aggs.bucket(
-            "requests_per_ip",
+        clients = q.aggs.bucket(
+            AGGREGATION_NAMES[aggtype],
             elasticsearch_dsl.A("terms", field=f"{CLIENT_IP_NAME}.keyword", size=no_hits, order={"bytes_sum": "desc"}),
-        ).metric("bytes_sum", "sum", field="bytes")
+        )
+        clients.metric("bytes_sum", "sum", field="bytes")
+        if limit:
+            clients.pipeline(
+                "over_limit",
+                "bucket_selector",
+                buckets_path={"value": "bytes_sum"},
+                script={"source": "params.value >= params.limit", "params": {"limit": limit}},
+            )
 
-    resp = await config.elasticsearch.search(index=threes, body=q.to_dict(), size=0, timeout="30s")
-    top_ips = []
-    if "aggregations" not in resp:
-        print(f"Could not find aggregated data. Are you sure the index pattern {config.index_pattern} exists?")
-        return []
 
-    for entry in resp["aggregations"]["requests_per_ip"]["buckets"]:
+def parse_top_clients(resp: dict, aggtype: typing.Literal["bytes", "requests"]) -> typing.List[typing.Tuple[str, int]]:
+    """Extracts (ip, value) pairs from a named top-clients aggregation in a search response"""
+    top_ips = []
+    for entry in resp["aggregations"][AGGREGATION_NAMES[aggtype]]["buckets"]:
         if "bytes_sum" in entry:
             top_ips.append(
                 (
@@ -113,122 +161,552 @@ async def find_top_clients(
     return top_ips
 
 
+def build_top_clients_query(
+    config: plugins.configuration.BlockyConfiguration,
+    aggtypes: typing.List[typing.Literal["bytes", "requests"]],
+    duration: str = "12h",
+    no_hits: int = 100,
+    filters: typing.List[str] = None,
+    limits: typing.Dict[str, int] = None,
+) -> dict:
+    """Builds the search body for finding the top clients by one or more aggregation types.
+    If limits (keyed by aggregation type) are given, only clients at or above them are returned."""
+    limits = limits or {}
+    q = build_search(config, duration, filters)
+    for aggtype in aggtypes:
+        add_top_clients_aggregation(q, aggtype, no_hits, limits.get(aggtype))
+    return q.to_dict()
+
+
+def build_incremental_query(
+    config: plugins.configuration.BlockyConfiguration,
+    aggtypes: typing.List[typing.Literal["bytes", "requests"]],
+    since: int,
+    until: int,
+    bucket_seconds: int = 60,
+    filters: typing.List[str] = None,
+    histogram: bool = True,
+) -> dict:
+    """Builds the search body for an incremental time slice, (since, until] in epoch seconds.
+    Returns the requests (and bytes, if needed) per IP, split into time buckets, or as a single total per IP if
+    histogram is False."""
+    q = build_search(
+        config, filters=filters, time_range={"gt": since * 1000, "lte": until * 1000, "format": "epoch_millis"}
+    )
+    clients = q.aggs.bucket("clients", "terms", field=f"{CLIENT_IP_NAME}.keyword", size=INCREMENTAL_MAX_CLIENTS)
+    if histogram:
+        clients = clients.bucket(
+            "slices", "date_histogram", field=TIMESTAMP_NAME, fixed_interval=f"{bucket_seconds}s", min_doc_count=1
+        )
+    if "bytes" in aggtypes:
+        clients.metric("bytes_sum", "sum", field="bytes")
+    return q.to_dict()
+
+
+async def iter_offenders(
+    config: plugins.configuration.BlockyConfiguration,
+    aggtype: typing.Literal["bytes", "requests"],
+    limit: int,
+    duration: str = "12h",
+    filters: typing.List[str] = None,
+    indices: typing.List[str] = None,
+    page_size: int = 1000,
+) -> typing.AsyncIterator[typing.Tuple[str, int]]:
+    """Yields every client (IP) at or above the limit, by either traffic volume (bytes) or requests.
+    Pages through a composite aggregation of all clients, with a bucket_selector that drops the clients below the
+    limit inside ES, so there is no cap on the number of offenders and counts are exact. Pages are fetched lazily,
+    as the caller consumes the offenders from the previous page."""
+    assert aggtype in ["bytes", "requests"], "Only by-bytes or by-requests aggregations are supported"
+    if indices is None:
+        indices = await config.resolve_indices(MAX_DB_DAYS)
+    if not indices:
+        return
+    after_key = None
+    while True:
+        q = build_search(config, duration, filters)
+        composite = {"sources": [{"ip": {"terms": {"field": f"{CLIENT_IP_NAME}.keyword"}}}], "size": page_size}
+        if after_key:
+            composite["after"] = after_key
+        clients = q.aggs.bucket("clients", "composite", **composite)
+        if aggtype == "bytes":
+            clients.metric("bytes_sum", "sum", field="bytes")
+        clients.pipeline(
+            "over_limit",
+            "bucket_selector",
+            buckets_path={"value": "bytes_sum" if aggtype == "bytes" else "_count"},
+            script={"source": "params.value >= params.limit", "params": {"limit": limit}},
+        )
+        config.es_requests += 1
+        with ES_SEARCH_DURATION.time(query="composite"):
+            resp = await config.elasticsearch.search(
+                index=",".join(indices), body=q.to_dict(), size=0, timeout=SEARCH_TIMEOUT
+            )
+        if "aggregations" not in resp:
+            print(f"Could not find aggregated data. Are you sure the index pattern {config.index_pattern} exists?")
+            return
+        for entry in resp["aggregations"]["clients"]["buckets"]:
+            if aggtype == "bytes":
+                yield entry["key"]["ip"], int(entry["bytes_sum"]["value"])
+            else:
+                yield entry["key"]["ip"], int(entry["doc_count"])
+        # Pages may come back empty when all their clients were below the limit; only a missing after_key means we are done
+        after_key = resp["aggregations"]["clients"].get("after_key")
+        if not after_key:
+            return
+
+
 class BanRule:
     def __init__(self, ruledict):
+        self.id = ruledict["id"]
         self.description = ruledict["description"]
         self.aggtype = ruledict["aggtype"]
         self.limit = ruledict["limit"]
         self.duration = ruledict["duration"]
         self.filters = [x.strip() for x in ruledict["filters"].split("\n") if x.strip()]
 
-    async def list_offenders(self, config: plugins.configuration.BlockyConfiguration):
-        """Find top clients by $metric, see if they cross the limit..."""
-        offenders = []
-        candidates = []
+    def filter_offenders(self, candidates: typing.List[typing.Tuple[str, int]]) -> typing.List[typing.Tuple[str, int]]:
+        """Returns the candidates that cross this rule's limit"""
+        return [candidate for candidate in candidates if candidate[1] >= self.limit]
+
+
+class RuleGroup:
+    """A set of ban rules that share the same filters and duration. These can all be answered by a single
+    search, with one aggregation per aggregation type (requests and/or bytes) in use within the group."""
+
+    def __init__(self, duration: str, filters: typing.List[str]):
+        self.duration = duration
+        self.filters = filters
+        self.rules: typing.List[BanRule] = []
+
+    @property
+    def key(self) -> typing.Tuple[str, typing.Tuple[str, ...]]:
+        return self.duration, tuple(self.filters)
+
+    @property
+    def aggtypes(self) -> typing.List[str]:
+        return sorted(set(rule.aggtype for rule in self.rules))
+
+    @property
+    def limits(self) -> typing.Dict[str, int]:
+        """The lowest limit in use for each aggregation type. Clients below these cannot be offenders."""
+        return {aggtype: min(rule.limit for rule in self.rules if rule.aggtype == aggtype) for aggtype in self.aggtypes}
+
+    def build_query(self, config: plugins.configuration.BlockyConfiguration) -> dict:
+        """Returns the combined search body for this group"""
+        return build_top_clients_query(
+            config, self.aggtypes, duration=self.duration, filters=self.filters, limits=self.limits
+        )
+
+    def offenders_from_response(self, resp: dict) -> typing.Dict[int, typing.List[typing.Tuple[str, int]]]:
+        """Returns the offenders for each rule in this group, keyed by rule ID, from a combined search response"""
+        if "aggregations" not in resp:
+            return {rule.id: [] for rule in self.rules}
+        candidates = {aggtype: parse_top_clients(resp, aggtype) for aggtype in self.aggtypes}
+        return {rule.id: rule.filter_offenders(candidates[rule.aggtype]) for rule in self.rules}
+
+
+def plan_queries(rules: typing.Iterable[BanRule]) -> typing.List[RuleGroup]:
+    """Groups together ban rules that share filters and duration, so each group only needs one search"""
+    groups = {}
+    for rule in rules:
+        key = (rule.duration, tuple(sorted(rule.filters)))
+        if key not in groups:
+            groups[key] = RuleGroup(rule.duration, list(key[1]))
+        groups[key].rules.append(rule)
+    return list(groups.values())
+
+
+class IncrementalState:
+    """Sliding-window counters for a rule group in incremental mode. Instead of aggregating the group's entire
+    duration on every cycle, only the time slice since the previous cycle is searched, and the results are
+    added to per-IP counters that expire as the window slides forward.
+
+    The first search has to backfill the whole window. Splitting that into time buckets for every client would
+    exceed ES's bucket limit, so the backfill is instead searched for per-IP totals, one chunk of the window per
+    cycle, oldest first. Each chunk's totals are counted at the middle of the chunk. Until the backfill has caught
+    up, offenders are found from the part of the window searched so far, which can only undercount."""
+
+    def __init__(self, group: RuleGroup, bucket_seconds: int):
+        self.window_seconds = parse_duration(group.duration)
+        self.bucket_seconds = bucket_seconds
+        self.chunk_seconds = max(bucket_seconds, self.window_seconds // BACKFILL_CHUNKS)
+        self.windows = {
+            aggtype: plugins.window.SlidingWindow(self.window_seconds, bucket_seconds) for aggtype in group.aggtypes
+        }
+        self.last_seen = None  # End of the latest time slice that has been added to the windows
+        self.now = None  # End of the window as of the search currently running
+        self.since = None  # Start of the time slice currently being searched for
+        self.pending = None  # End of the time slice currently being searched for
+        self.backfilling = False  # Whether the current search is for per-IP totals rather than per-bucket counts
+        self.applied = True  # Whether the result of the current search has been added to the windows
+
+    def build_query(self, config: plugins.configuration.BlockyConfiguration, group: RuleGroup) -> dict:
+        """Builds the search for everything since the previous slice, or for the next chunk of the backfill"""
+        now = int(time.time()) - config.incremental_lag
+        since = now - self.window_seconds
+        if self.last_seen is not None:
+            since = max(since, self.last_seen)  # Anything older than that has left the window already
+        until = now
+        self.backfilling = now - since > self.bucket_seconds * INCREMENTAL_MAX_SLICES
+        if self.backfilling:
+            until = min(now, since + self.chunk_seconds)
+        self.now, self.since, self.pending, self.applied = now, since, until, False
+        return build_incremental_query(
+            config, group.aggtypes, since, until, self.bucket_seconds, group.filters, histogram=not self.backfilling
+        )
+
+    def update(self, group: RuleGroup, resp: dict) -> typing.Dict[int, typing.List[typing.Tuple[str, int]]]:
+        """Adds a time slice search response to the windows, and returns the offenders for each rule in the group"""
+        for window in self.windows.values():
+            window.expire(self.now)
+        if "aggregations" in resp:
+            requests = self.windows.get("requests")
+            traffic = self.windows.get("bytes")
+            middle = self.since + (self.pending - self.since) // 2
+            for client in resp["aggregations"]["clients"]["buckets"]:
+                ip = client["key"]
+                if "slices" in client:
+                    time_slices = [
+                        (int(time_slice["key"]) // 1000, time_slice) for time_slice in client["slices"]["buckets"]
+                    ]
+                else:
+                    time_slices = [(middle, client)]
+                for timestamp, time_slice in time_slices:
+                    if requests is not None:
+                        requests.add(timestamp, ip, int(time_slice["doc_count"]))
+                    if traffic is not None:
+                        traffic.add(timestamp, ip, int(time_slice["bytes_sum"]["value"]))
+            self.last_seen = self.pending
+            self.applied = True
+        limits = group.limits
+        candidates = {aggtype: window.over(limits[aggtype]) for aggtype, window in self.windows.items()}
+        return {rule.id: rule.filter_offenders(candidates[rule.aggtype]) for rule in group.rules}
+
+    def failed(self, group: RuleGroup):
+        """Reports a search whose time slice could not be added to the windows. The next search starts from the
+        same point, so nothing is lost, but a slice that keeps failing would hold the window back."""
+        phase = "backfill" if self.backfilling else "slice"
+        INCREMENTAL_FAILURES.inc(phase=phase)
+        rule_ids = ", ".join(f"#{rule.id}" for rule in group.rules)
+        print(
+            f"Incremental {phase} search for rule(s) {rule_ids} from {self.since} to {self.pending} failed, "
+            "retrying next cycle"
+        )
+        self.applied = True
+
+
+def is_listed(config: plugins.configuration.BlockyConfiguration, ip: netaddr.IPAddress) -> bool:
+    """Returns True if an IP is on the allow list or already blocked"""
+    return config.allow_list.longest_match(ip) is not None or config.block_list.longest_match(ip) is not None
+
+
+async def ban_offenders(config: plugins.configuration.BlockyConfiguration, rule: BanRule, offenders: typing.List[typing.Tuple[str, int]]):
+    """Adds offenders found by a rule to the block list, unless they are allowed or already blocked.
+    The santa's list entries of all new offenders are looked up at once, before any of them is banned."""
+    offenders = [offender for offender in offenders if not is_listed(config, netaddr.IPAddress(offender[0]))]
+    if not offenders:
+        return
+    await config.santa_list.load(offender[0] for offender in offenders)
+    for offender in offenders:
+        off_ip = offender[0]
+        off_limit = offender[1]
+        # Another rule may have blocked this IP while we were waiting for the database
+        if is_listed(config, netaddr.IPAddress(off_ip)):
+            continue
+        santa_entry = config.santa_list.get(off_ip) or {
+            "ip": off_ip,
+            "niceness": 0,
+        }
+        off_reason = f"{rule.description} ({off_limit} >= {rule.limit})"
+        print(f"Found new offender, {off_ip}: {off_reason}")
+        OFFENDERS_BLOCKED.inc()
+        now = int(time.time())
+        santa_entry["updated"] = now
+        santa_entry["niceness"] = santa_entry.get("niceness", 0) - 1
+        santa_entry["token"] = str(uuid.uuid4())  # We always refresh this when a new infraction incurs to prevent token pre-caching
+
+        # TODO: "Configify" this
+        expires = now + config.default_expire_seconds
+        if santa_entry["niceness"] >= -2:  # First two infractions gets you a week suspension
+           expires = now + (7*86400)
+        elif santa_entry["niceness"] == -3:  # Next gets you a month
+           expires = now + int(30.3*86400)
+        else: # Next gets you six months
+            expires = now + int(6*30.3*86400)
+
+        config.block_list.add(
+            ip=off_ip,
+            timestamp=now,
+            expires=expires,
+            reason=off_reason,
+            host=plugins.configuration.DEFAULT_HOST_BLOCK,
+        )
+
+        # upsert santa list entry
+        config.santa_list.save(santa_entry)
+
+
+class RuleRunner:
+    """Runs all ban rules concurrently, with bounded parallelism and a deadline for each search.
+    Rules that share filters and duration are merged into one search (see plan_queries).
+    In batch mode, the searches for all rule groups are instead sent as a single multi-search request.
+    In incremental mode, each group only searches the time slice since its previous search (see IncrementalState).
+    A search that is still running (or waiting for a slot) from a previous cycle is skipped."""
+
+    def __init__(self, config: plugins.configuration.BlockyConfiguration):
+        self.config = config
+        self.semaphore = asyncio.Semaphore(config.rule_concurrency)
+        self.in_flight: typing.Dict[tuple, asyncio.Task] = {}
+        self.incremental: typing.Dict[tuple, IncrementalState] = {}
+
+    def incremental_state(self, group: RuleGroup) -> IncrementalState:
+        """Returns the sliding windows of a rule group in incremental mode, creating them if need be"""
+        key = (group.key, tuple(group.aggtypes))
+        if key not in self.incremental:
+            self.incremental[key] = IncrementalState(group, self.config.incremental_bucket)
+        return self.incremental[key]
+
+    def build_query(self, group: RuleGroup) -> dict:
+        """Builds the search body for a rule group"""
+        if self.config.incremental_rules:
+            return self.incremental_state(group).build_query(self.config, group)
+        return group.build_query(self.config)
+
+    def parse_response(self, group: RuleGroup, resp: dict) -> typing.Dict[int, typing.List[typing.Tuple[str, int]]]:
+        """Returns the offenders for each rule in a group, keyed by rule ID, from the group's search response"""
+        if self.config.incremental_rules:
+            return self.incremental_state(group).update(group, resp)
+        return group.offenders_from_response(resp)
+
+    async def search_group(
+        self, group: RuleGroup, indices: typing.List[str]
+    ) -> typing.Optional[typing.Dict[int, typing.List[typing.Tuple[str, int]]]]:
+        """Runs the search for a rule group. Returns the offenders for each rule, or None if the search failed."""
+        if not indices:
+            return {rule.id: [] for rule in group.rules}
+        body = self.build_query(group)
         try:
-            candidates = await find_top_clients(config, aggtype=self.aggtype, duration=self.duration, filters=self.filters)
-        except (asyncio.exceptions.TimeoutError, elasticsearch.exceptions.ConnectionTimeout, elasticsearch.exceptions.ConnectionError):
+            self.config.es_requests += 1
+            with ES_SEARCH_DURATION.time(query="incremental" if self.config.incremental_rules else "top_clients"):
+                resp = await self.config.elasticsearch.search(
+                    index=",".join(indices), body=body, size=0, timeout=SEARCH_TIMEOUT
+                )
+        except (elasticsearch.exceptions.ConnectionTimeout, elasticsearch.exceptions.ConnectionError):
             print("Offender search timed out, retrying later!")
+            return None
         except elasticsearch.exceptions.TransportError:
             print("Transport error (503?), retrying later")
-        for candidate in candidates:
-            if candidate[1] >= self.limit:
-                offenders.append(candidate)
-        return offenders
+            return None
+        if "aggregations" not in resp:
+            print(f"Could not find aggregated data. Are you sure the index pattern {self.config.index_pattern} exists?")
+        return self.parse_response(group, resp)
+
+    async def msearch(
+        self, groups: typing.List[RuleGroup], indices: typing.List[str]
+    ) -> typing.Dict[tuple, typing.Optional[typing.Dict[int, typing.List[typing.Tuple[str, int]]]]]:
+        """Sends the searches for all rule groups as a single multi-search request. Returns the offenders for each
+        group, keyed by group key. A group whose search failed maps to None, without affecting the other groups."""
+        results = {}
+        if not indices:
+            return {group.key: {rule.id: [] for rule in group.rules} for group in groups}
+        body = []
+        for group in groups:
+            query = self.build_query(group)
+            query["size"] = 0
+            query["timeout"] = SEARCH_TIMEOUT
+            body.append({"index": ",".join(indices)})
+            body.append(query)
+        self.config.es_requests += 1
+        with ES_SEARCH_DURATION.time(query="msearch"):
+            resp = await self.config.elasticsearch.msearch(body=body)
+        for group, sub_resp in zip(groups, resp["responses"]):
+            if "error" in sub_resp:
+                descriptions = ", ".join(f"#{rule.id}" for rule in group.rules)
+                print(f"Search for rule(s) {descriptions} failed (status {sub_resp.get('status')}), retrying later: {sub_resp['error']}")
+                results[group.key] = None
+            else:
+                results[group.key] = self.parse_response(group, sub_resp)
+        return results
+
+    async def record(self, group: RuleGroup, started: float, offenders: typing.Optional[typing.Dict[int, typing.Sized]]):
+        """Records timing and results for a group's search, and bans any offenders found.
+        In streaming mode, offenders have already been banned, and only their number is recorded."""
+        duration = round(time.time() - started, 3)
+        if self.config.incremental_rules:
+            state = self.incremental.get((group.key, tuple(group.aggtypes)))
+            if state and not state.applied:
+                state.failed(group)
+        for rule in group.rules:
+            stats = self.config.rule_stats[rule.id]
+            stats["runs"] += 1
+            stats["last_run"] = int(started)
+            stats["last_duration"] = duration
+            stats["max_duration"] = max(stats["max_duration"], duration)
+            stats["group_size"] = len(group.rules)
+            if offenders is None:
+                stats["errors"] += 1
+                stats["last_offenders"] = 0
+                RULE_FAILURES.inc(rule=rule.id, reason="error")
+            elif isinstance(offenders[rule.id], int):
+                stats["last_offenders"] = offenders[rule.id]
+            else:
+                stats["last_offenders"] = len(offenders[rule.id])
+            RULE_DURATION.observe(duration, rule=rule.id)
+            RULE_OFFENDERS.inc(stats["last_offenders"], rule=rule.id)
+        for rule in group.rules:
+            if offenders and not isinstance(offenders[rule.id], int):
+                await ban_offenders(self.config, rule, offenders[rule.id])
+
+    def timed_out(self, groups: typing.List[RuleGroup]):
+        descriptions = ", ".join(f"#{rule.id} ({rule.description})" for group in groups for rule in group.rules)
+        print(f"Rule(s) {descriptions} did not finish within {self.config.rule_timeout} seconds, retrying later!")
+        for group in groups:
+            for rule in group.rules:
+                self.config.rule_stats[rule.id]["timeouts"] += 1
+                RULE_FAILURES.inc(rule=rule.id, reason="timeout")
+
+    async def stream_group(self, group: RuleGroup, indices: typing.List[str]) -> typing.Optional[typing.Dict[int, int]]:
+        """Pages through all offenders for a rule group using composite aggregations, banning them as they
+        arrive. Returns the number of offenders found for each rule, or None if the search failed."""
+        found = {rule.id: 0 for rule in group.rules}
+        try:
+            for aggtype in group.aggtypes:
+                rules = [rule for rule in group.rules if rule.aggtype == aggtype]
+                async for offender in iter_offenders(
+                    self.config, aggtype, group.limits[aggtype], group.duration, group.filters, indices, self.config.composite_page_size
+                ):
+                    for rule in rules:
+                        if offender[1] >= rule.limit:
+                            found[rule.id] += 1
+                            await ban_offenders(self.config, rule, [offender])
+        except (elasticsearch.exceptions.ConnectionTimeout, elasticsearch.exceptions.ConnectionError):
+            print("Offender search timed out, retrying later!")
+            return None
+        except elasticsearch.exceptions.TransportError:
+            print("Transport error (503?), retrying later")
+            return None
+        return found
+
+    async def run_group(self, group: RuleGroup, indices: typing.List[str]):
+        async with self.semaphore:
+            started = time.time()
+            offenders = {rule.id: [] for rule in group.rules}
+            search = self.search_group
+            if self.config.composite_rules and not self.config.incremental_rules:
+                search = self.stream_group
+            try:
+                offenders = await asyncio.wait_for(search(group, indices), timeout=self.config.rule_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out([group])
+            await self.record(group, started, offenders)
+
+    async def run_batch(self, groups: typing.List[RuleGroup], indices: typing.List[str]):
+        started = time.time()
+        results = {}
+        try:
+            results = await asyncio.wait_for(self.msearch(groups, indices), timeout=self.config.rule_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out(groups)
+            results = {group.key: {rule.id: [] for rule in group.rules} for group in groups}
+        except elasticsearch.exceptions.TransportError as e:
+            print(f"Batched rule search failed, retrying later: {e}")
+        for group in groups:
+            await self.record(group, started, results.get(group.key))
+
+    async def run_cycle(self):
+        """Starts a run of every rule group, and waits up to one search deadline for them to finish"""
+        started = time.time()
+        es_requests = self.config.es_requests
+        tasks = []
+        rule_ids = set()
+
+        # Look up which indices to search once, and share that across all rules in this cycle
+        try:
+            indices = await self.config.resolve_indices(MAX_DB_DAYS)
+        except elasticsearch.exceptions.TransportError as e:
+            print(f"Could not look up indices in ES, retrying later: {e}")
+            return
+
+        rules = [BanRule(ruledict) for ruledict in await self.config.db.fetch("rules", limit=0)]
+        for rule in rules:
+            rule_ids.add(rule.id)
+            stats = self.config.rule_stats.setdefault(
+                rule.id,
+                {
+                    "id": rule.id,
+                    "runs": 0,
+                    "skipped": 0,
+                    "timeouts": 0,
+                    "errors": 0,
+                    "last_run": 0,
+                    "last_duration": 0,
+                    "max_duration": 0,
+                    "last_offenders": 0,
+                    "group_size": 1,
+                },
+            )
+            stats["description"] = rule.description
+
+        planned = plan_queries(rules)
+        groups = []
+        for group in planned:
+            # In batch mode, all groups share the one multi-search task
+            task = self.in_flight.get("batch" if self.config.batch_searches and not self.config.composite_rules else group.key)
+            if task and not task.done():
+                for rule in group.rules:
+                    print(f"Rule #{rule.id} ({rule.description}) is still running from a previous cycle, skipping.")
+                    self.config.rule_stats[rule.id]["skipped"] += 1
+                continue
+            groups.append(group)
+        if self.config.batch_searches and not self.config.composite_rules:
+            if groups:
+                task = asyncio.create_task(self.run_batch(groups, indices))
+                self.in_flight["batch"] = task
+                tasks.append(task)
+        else:
+            for group in groups:
+                task = asyncio.create_task(self.run_group(group, indices))
+                self.in_flight[group.key] = task
+                tasks.append(task)
+
+        # Forget about rules that have since been deleted, and searches that have finished
+        for rule_id in list(self.config.rule_stats):
+            if rule_id not in rule_ids:
+                del self.config.rule_stats[rule_id]
+                for metric in (RULE_DURATION, RULE_OFFENDERS, RULE_FAILURES):
+                    metric.remove(rule=rule_id)
+        for key, task in list(self.in_flight.items()):
+            if task.done() and task not in tasks:
+                del self.in_flight[key]
+        group_keys = set(group.key for group in planned)
+        for key in list(self.incremental):
+            if key[0] not in group_keys:
+                del self.incremental[key]
+
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.config.rule_timeout)
+        CYCLE_DURATION.observe(time.time() - started)
+        self.config.cycle_stats.update(
+            {
+                "last_run": int(started),
+                "last_duration": round(time.time() - started, 3),
+                "rules": len(rules),
+                "searches_started": len(groups),
+                "searches_running": sum(1 for task in self.in_flight.values() if not task.done()),
+                "es_requests": self.config.es_requests - es_requests,
+            }
+        )
 
 
 async def run(config: plugins.configuration.BlockyConfiguration):
+    runner = RuleRunner(config)
 
     # Search forever, sleep a little in between
     while True:
-        # Find expired rules
-        now = int(time.time())
-        all_items = [item for item in config.sqlite.fetch("lists", limit=0)]
-        for item in all_items:
-            if item['expires'] == -1:
-                continue  # never expires
-            if item['expires'] < now:
-                print(f"Expiring {item['type']} rule for {item['ip']}")
-                if item['type'] == 'allow':
-                    config.allow_list.remove(item['ip'])
-                elif item['type'] == 'block':
-                    config.block_list.remove(item['ip'])
-                    # Try adding a temporary whitelist entry to flush on hosts
-                    try:
-                        config.allow_list.add(
-                            ip=item["ip"],
-                            timestamp=now,
-                            expires=now + 600,  # Expire this rule in 10 minutes
-                            reason="Temporary allow-listed by BLocky4 to unblock IP due to block expiring",
-                            host=plugins.configuration.DEFAULT_HOST_BLOCK,
-                            force=False
-                        )
-                    except plugins.lists.BlockListException:
-                        pass  # If it conflicts, it should already be unblocked, so we don't care.
-                else:
-                    print("I don't actually know items of type {item['type']}, ignoring...")
-
-        all_rules = [item for item in config.sqlite.fetch("rules", limit=0)]
-        for rule in all_rules:
-            #  print(f"Running rule #{rule['id']}: {rule['description']}...")
-            my_rule = BanRule(rule)
-            off = await my_rule.list_offenders(config)
-            if off:
-                for offender in off:
-                    off_ip = offender[0]
-                    off_limit = offender[1]
-                    off_ip_na = netaddr.IPAddress(off_ip)
-                    ignore_ip = False
-                    for allowed_ip in config.allow_list:
-                        if (
-                            isinstance(allowed_ip.network, netaddr.IPNetwork)
-                            and off_ip_na in allowed_ip.network
-                            or isinstance(allowed_ip.network, netaddr.IPAddress)
-                            and off_ip_na == allowed_ip.network
-                        ):
-                            #  print(f"IP {off_ip} is on the allow list, ignoring...")
-                            ignore_ip = True
-                            break
-                    for blocked_ip in config.block_list:
-                        if (
-                            isinstance(blocked_ip.network, netaddr.IPNetwork)
-                            and off_ip_na in blocked_ip.network
-                            or isinstance(blocked_ip.network, netaddr.IPAddress)
-                            and off_ip_na == blocked_ip.network
-                        ):
-                            #  print(f"IP {off_ip} is already blocked, ignoring...")
-                            ignore_ip = True
-                            break
-                    if not ignore_ip:
-                        off_reason = f"{rule['description']} ({off_limit} >= {rule['limit']})"
-                        print(f"Found new offender, {off_ip}: {off_reason}")
-                        now = int(time.time())
-                        santa_entry = config.sqlite.fetchone("santalist", ip=off_ip) or {
-                            "ip": off_ip,
-                            "niceness": 0,
-                        }
-                        santa_entry["updated"] = now
-                        santa_entry["niceness"] = santa_entry.get("niceness", 0) - 1
-                        santa_entry["token"] = str(uuid.uuid4())  # We always refresh this when a new infraction incurs to prevent token pre-caching
-                        
-                        # TODO: "Configify" this
-                        expires = now + config.default_expire_seconds
-                        if santa_entry["niceness"] >= -2:  # First two infractions gets you a week suspension
-                           expires = now + (7*86400)
-                        elif santa_entry["niceness"] == -3:  # Next gets you a month
-                           expires = now + (30.3*86400)
-                        else: # Next gets you six months
-                            expires = now + (6*30.3*86400)
-                        
-                        config.block_list.add(
-                            ip=off_ip,
-                            timestamp=now,
-                            expires=expires,
-                            reason=off_reason,
-                            host=plugins.configuration.DEFAULT_HOST_BLOCK,
-                        )
-
-                        # upsert santa list entry
-                        config.sqlite.upsert("santalist", santa_entry, ip=off_ip)
-                        
+        # Run all ban rules
+        await runner.run_cycle()
+
+        # Write this cycle's list, audit log and santa list changes to disk in one go
+        await config.db.flush()
+
         await asyncio.sleep(15)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import socket
+import typing
+import plugins.configuration
+import plugins.lists
+import plugins.radix
+
+""" Compiled, per-host block sets for exporting to clients as ipset/nftables restore files """
+
+FORMATS = ("ipset", "nft")
+MAX_CACHED_SETS = 1024  # Number of compiled (host, format, name) block sets to keep around
+ADDRESS_FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+Interval = typing.Tuple[int, int]  # First and last address, inclusive
+
+
+def to_intervals(entries: typing.Iterable["plugins.lists.IPEntry"], version: int) -> typing.List[Interval]:
+    """Returns the address ranges of all entries of an IP version, sorted and merged where they touch or overlap"""
+    bits = plugins.radix.ADDRESS_BITS[version]
+    ranges = sorted(
+        (entry.first, entry.first + (1 << (bits - entry.prefixlen)) - 1) for entry in entries if entry.version == version
+    )
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def subtract(intervals: typing.List[Interval], holes: typing.List[Interval]) -> typing.List[Interval]:
+    """Removes the (sorted, merged) holes from the (sorted, merged) intervals"""
+    result = []
+    i = 0
+    for first, last in intervals:
+        while i < len(holes) and holes[i][1] < first:
+            i += 1
+        j = i
+        while j < len(holes) and holes[j][0] <= last:
+            hole_first, hole_last = holes[j]
+            if hole_first > first:
+                result.append((first, hole_first - 1))
+            first = hole_last + 1
+            if first > last:
+                break
+            j += 1
+        if first <= last:
+            result.append((first, last))
+    return result
+
+
+def to_cidrs(intervals: typing.List[Interval], version: int) -> typing.Iterator[str]:
+    """Splits address ranges into the fewest CIDR blocks that exactly cover them"""
+    bits = plugins.radix.ADDRESS_BITS[version]
+    family = ADDRESS_FAMILIES[version]
+    for first, last in intervals:
+        while first <= last:
+            # The largest block that starts at $first is bounded both by its alignment and by what is left of the range
+            size = (first & -first).bit_length() - 1 if first else bits
+            size = min(size, (last - first + 1).bit_length() - 1)
+            address = socket.inet_ntop(family, first.to_bytes(bits // 8, "big"))
+            yield f"{address}/{bits - size}"
+            first += 1 << size
+
+
+def compile_host(state: "plugins.configuration.BlockyConfiguration", host: str) -> typing.Dict[int, typing.List[str]]:
+    """Returns the effective block set for a host, as merged CIDR blocks per IP version: everything blocked for all
+    hosts or for this host specifically, minus anything allowed for all hosts or for this host specifically"""
+    hosts = {plugins.configuration.DEFAULT_HOST_BLOCK, host}
+    blocks = [entry for x_host in hosts for entry in state.block_list.by_host(x_host)]
+    allows = [entry for x_host in hosts for entry in state.allow_list.by_host(x_host)]
+    return {
+        version: list(to_cidrs(subtract(to_intervals(blocks, version), to_intervals(allows, version)), version))
+        for version in plugins.radix.ADDRESS_BITS
+    }
+
+
+def render_ipset(cidrs: typing.Dict[int, typing.List[str]], name: str) -> str:
+    """Renders a block set as input for `ipset restore`, with one hash:net set per IP version"""
+    lines = []
+    for version, family, set_name in ((4, "inet", name), (6, "inet6", f"{name}-v6")):
+        maxelem = max(65536, len(cidrs[version]))
+        lines.append(f"create {set_name} hash:net family {family} maxelem {maxelem} -exist")
+        lines.append(f"flush {set_name}")
+        lines.extend(f"add {set_name} {cidr}" for cidr in cidrs[version])
+    return "\n".join(lines) + "\n"
+
+
+def render_nft(cidrs: typing.Dict[int, typing.List[str]], name: str) -> str:
+    """Renders a block set as input for `nft -f`, as one interval set per IP version in an inet table"""
+    lines = [
+        f"table inet {name} {{",
+        "\tset block_v4 { type ipv4_addr; flags interval; }",
+        "\tset block_v6 { type ipv6_addr; flags interval; }",
+        "}",
+        f"flush set inet {name} block_v4",
+        f"flush set inet {name} block_v6",
+    ]
+    for version in (4, 6):
+        if cidrs[version]:
+            lines.append(f"add element inet {name} block_v{version} {{ {', '.join(cidrs[version])} }}")
+    return "\n".join(lines) + "\n"
+
+
+class BlockSetCache:
+    """Keeps rendered block sets, per host and format, until either list changes"""
+
+    def __init__(self, state: "plugins.configuration.BlockyConfiguration"):
+        self.state = state
+        self.cache: typing.MutableMapping[tuple, typing.Tuple[tuple, str]] = collections.OrderedDict()
+
+    def versions(self) -> tuple:
+        return self.state.block_list.version, self.state.allow_list.version
+
+    def get(self, host: str, output_format: str = "ipset", name: str = "blocky4") -> str:
+        """Returns the rendered block set for a host, compiling it only if the lists have changed since last time"""
+        assert output_format in FORMATS, f"Unknown export format: {output_format}"
+        key = (host, output_format, name)
+        versions = self.versions()
+        cached = self.cache.get(key)
+        if cached and cached[0] == versions:
+            self.cache.move_to_end(key)
+            return cached[1]
+        cidrs = compile_host(self.state, host)
+        text = render_ipset(cidrs, name) if output_format == "ipset" else render_nft(cidrs, name)
+        self.cache[key] = (versions, text)
+        self.cache.move_to_end(key)
+        while len(self.cache) > MAX_CACHED_SETS:
+            self.cache.popitem(last=False)
+        return text
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+""" HTTP caching helpers for Blocky/4 endpoints """
+
+INSTANCE_ID = uuid.uuid4().hex[:8]  # Part of every ETag, so list versions from before a restart never match
+
+
+def make_etag(*parts) -> str:
+    """Builds a strong ETag from the given version numbers/variant names"""
+    return '"' + "-".join(str(part) for part in (INSTANCE_ID,) + parts) + '"'
+
+
+def etag_matches(request, etag: str) -> bool:
+    """Returns True if the client already has this ETag, as told by If-None-Match"""
+    if_none_match = request.headers.get("If-None-Match", "")
+    return any(tag.strip().replace("W/", "", 1) == etag for tag in if_none_match.split(",")) or if_none_match == "*"
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import atexit
+import typing
+import plugins.configuration
+import plugins.lists
+
+""" Sequenced change log of allow/block list changes, for delta syncing clients """
+
+TRIM_BATCH = 1000  # Trim the log once it has grown this many changes past its size
+SEQ_RESERVE = 1000  # Sequence numbers are reserved on disk this many at a time, before any of them is handed out
+
+
+class Change(typing.NamedTuple):
+    seq: int
+    action: str  # "add" or "remove"
+    type: str  # "block" or "allow"
+    entry: "plugins.lists.IPEntry"
+
+    def to_dict(self) -> dict:
+        return dict(self.entry.to_dict(), seq=self.seq, action=self.action, type=self.type)
+
+
+class ChangeLog:
+    """Gives every list change a global, ever-increasing sequence number, and keeps the latest $size changes both
+    in memory (for serving) and in the changelog table (so sequence numbers carry on across restarts). Clients
+    that are further behind than the log reaches have to resync from the full lists.
+
+    Changes are written through the write-behind queue, so a crash can lose the latest ones after clients have
+    already seen their sequence numbers. To never hand out a number twice, numbers are reserved in the
+    changelog_state table, written straight to disk, before they are used, and the unused part of the reservation is
+    released on a clean shutdown. A reservation beyond the last change on disk at startup thus means changes were
+    lost: the log then starts over from the reservation, so every client that is behind resyncs.
+    Once the event loop is running, the next range is reserved on the writer thread while half of the current one is
+    still left, so changes do not wait for it. Only a burst that uses up the rest first reserves on the spot."""
+
+    def __init__(self, state: "plugins.configuration.BlockyConfiguration", size: int):
+        self.state = state
+        self.size = size
+        rows = state.sqlite.query("SELECT * FROM changelog ORDER BY seq DESC LIMIT ?", size)
+        self.changes: typing.List[Change] = [
+            Change(
+                row["seq"],
+                row["action"],
+                row["type"],
+                plugins.lists.IPEntry(row["ip"], row["timestamp"], row["expires"], row["reason"], row["host"]),
+            )
+            for row in reversed(rows)
+        ]
+        self.seq = self.changes[-1].seq if self.changes else 0
+        rows = state.sqlite.query('SELECT reserved FROM "changelog_state" WHERE id = 0')
+        reserved = rows[0]["reserved"] if rows else 0
+        if reserved > self.seq:
+            print(f"Changes after #{self.seq} (up to #{reserved}) may have been lost at shutdown, starting the log over")
+            state.sqlite.runc("DELETE FROM changelog WHERE seq <= ?", reserved)
+            self.changes = []
+            self.seq = reserved
+        self.reserved = 0  # Sequence numbers up to this one are reserved on disk
+        self.reserving = False  # Whether the next range is being reserved on the writer thread
+        self.reserve(self.seq + SEQ_RESERVE)
+        atexit.register(self.release)
+
+    @staticmethod
+    def write_reservation(db: "plugins.storage.BlockyDB", reserved: int):
+        """Writes a reservation to disk right away. Reservations made on the writer thread can finish after a later
+        one made on the spot, so the highest reservation wins."""
+        with db.lock:
+            db.run('INSERT OR IGNORE INTO "changelog_state" (id, reserved) VALUES (0, ?)', reserved)
+            db.run('UPDATE "changelog_state" SET reserved = MAX(reserved, ?) WHERE id = 0', reserved)
+
+    def reserve(self, reserved: int):
+        """Reserves sequence numbers up to $reserved on the spot"""
+        self.write_reservation(self.state.sqlite, reserved)
+        self.reserved = max(self.reserved, reserved)
+
+    def reserve_ahead(self):
+        """Starts reserving the next range of sequence numbers on the writer thread, if the event loop is running"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # At startup, the range is reserved on the spot once it runs out
+        self.reserving = True
+        reserved = self.reserved + SEQ_RESERVE
+        task = asyncio.ensure_future(self.state.db.run(lambda db: self.write_reservation(db, reserved)))
+
+        def done(task: asyncio.Future):
+            self.reserving = False
+            if task.cancelled():
+                return
+            if task.exception():
+                print(f"Could not reserve change log sequence numbers, will retry: {task.exception()}")
+                return
+            self.reserved = max(self.reserved, reserved)
+
+        task.add_done_callback(done)
+
+    def release(self):
+        """Gives back the unused sequence numbers on shutdown, once the last changes have been written. Does nothing
+        if the database has already been closed or the changes could not be written: the reservation then stays,
+        and the next start treats the numbers as lost."""
+        db = self.state.sqlite
+        with db.lock:
+            if not db.is_open():
+                return
+            db.flush()
+            if db.pending:
+                return
+            db.run('UPDATE "changelog_state" SET reserved = ? WHERE id = 0', self.seq)
+
+    def record(self, action: str, list_type: str, entry: "plugins.lists.IPEntry") -> int:
+        """Logs a change to a list, returning its sequence number"""
+        if self.seq >= self.reserved:
+            self.reserve(self.seq + SEQ_RESERVE)  # Reserving ahead did not keep up
+        elif self.seq >= self.reserved - SEQ_RESERVE // 2 and not self.reserving:
+            self.reserve_ahead()
+        self.seq += 1
+        self.changes.append(Change(self.seq, action, list_type, entry))
+        self.state.sqlite.insert("changelog", dict(entry.to_dict(), seq=self.seq, action=action, type=list_type))
+        if len(self.changes) >= self.size + TRIM_BATCH:
+            del self.changes[: len(self.changes) - self.size]
+            self.state.sqlite.runc("DELETE FROM changelog WHERE seq < ?", self.changes[0].seq)
+        return self.seq
+
+    def oldest(self) -> int:
+        """Returns the sequence number of the oldest change still in the log"""
+        return self.changes[0].seq if self.changes else self.seq + 1
+
+    def since(self, seq: int) -> typing.Optional[typing.List[Change]]:
+        """Returns all changes after the given sequence number, or None if some of them are no longer in the log"""
+        if seq > self.seq or seq < self.oldest() - 1:
+            return None
+        # Sequence numbers are consecutive, so the position of a change in the log follows from its number
+        return self.changes[seq + 1 - self.oldest():]
@@ -18,15 +18,38 @@
 
 # Configuration objects for Blocky/4
 
-import asfpy.sqlite
+import datetime
 import elasticsearch
-import plugins.db_create
+import time
+import typing
+import plugins.auditlog
+import plugins.blockset
+import plugins.changelog
+import plugins.expiry
+import plugins.iptables
 import plugins.lists
+import plugins.migrations
+import plugins.pubsub
+import plugins.santalist
+import plugins.storage
 
 
 DEFAULT_EXPIRE = 86400 * 30 * 4  # Default expiry of auto-bans = 4 months
 DEFAULT_INDEX_PATTERN = "loggy-%Y-%m-%d"
 DEFAULT_HOST_BLOCK = "*"  # Default hostname to block on. * means all hosts
+DEFAULT_RULE_CONCURRENCY = 4  # Number of ban rules that may query ES at the same time
+DEFAULT_RULE_TIMEOUT = 45  # Max number of seconds a single ban rule may take per run
+DEFAULT_INCREMENTAL_BUCKET = 60  # Width, in seconds, of each time bucket in incremental rule windows
+DEFAULT_INCREMENTAL_LAG = 30  # Incremental rules only search up to this many seconds ago, to allow for indexing delays
+DEFAULT_COMPOSITE_PAGE_SIZE = 1000  # Number of clients per page when paging through composite aggregations
+DEFAULT_SQLITE_FLUSH_INTERVAL = 500  # Milliseconds between each write of queued database changes to disk
+DEFAULT_SQLITE_READERS = 4  # Number of threads (and connections) serving database reads
+DEFAULT_INDEX_CACHE_TTL = 300  # Number of seconds to cache the list of existing ES indices for
+DEFAULT_CHANGELOG_SIZE = 100000  # Number of list changes to keep for clients syncing deltas
+DEFAULT_AUDIT_RETENTION = 90  # Days to keep audit log entries in the database before archiving them. 0 keeps them all
+DEFAULT_AUDIT_BATCH_SIZE = 1000  # Number of audit log entries archived (and deleted) at a time
+DEFAULT_PUBSUB_BATCH_SIZE = 50  # Max number of events sent to pyPubSub in one POST. 1 sends every event by itself
+DEFAULT_PUBSUB_LINGER = 20  # Milliseconds to wait for more events to send along with one, when batching
 
 # These IP blocks should always be allowed and never blocked, or else...
 DEFAULT_ALLOW_LIST = [
@@ -39,32 +62,59 @@ DEFAULT_ALLOW_LIST = [
 class BlockyConfiguration:
     def __init__(self, yml):
         self.database_filepath = yml.get("database", "blocky.sqlite")
-        self.sqlite = asfpy.sqlite.DB(self.database_filepath)
+        self.sqlite_flush_interval = int(yml.get("sqlite_flush_interval", DEFAULT_SQLITE_FLUSH_INTERVAL))
+        self.sqlite = plugins.storage.BlockyDB(
+            self.database_filepath,
+            journal_mode=yml.get("sqlite_journal_mode", "WAL"),
+            synchronous=yml.get("sqlite_synchronous", "NORMAL"),
+        )
+        # Async interface to the database, for use once the event loop is running
+        self.db = plugins.storage.AsyncDB(
+            self.sqlite, self.database_filepath, readers=int(yml.get("sqlite_readers", DEFAULT_SQLITE_READERS))
+        )
         self.default_expire_seconds = yml.get("default_expire", DEFAULT_EXPIRE)
         self.index_pattern = yml.get("index_pattern", DEFAULT_INDEX_PATTERN)
         self.elasticsearch_url = yml.get("elasticsearch_url")
         self.elasticsearch = elasticsearch.AsyncElasticsearch(hosts=[self.elasticsearch_url])
         self.http_ip = yml.get("bind_ip", "127.0.0.1")
         self.http_port = int(yml.get("bind_port", 8080))
-        self.client_iptables = {}  # Uploaded iptables from blocky clients. Only kept in memory.
+        self.client_iptables = plugins.iptables.IPTablesIndex()  # Uploaded iptables from blocky clients. Only kept in memory.
         self.pubsub_host = yml.get('pubsub_host')
         self.pubsub_user = yml.get('pubsub_user')
         self.pubsub_password = yml.get('pubsub_password')
+        self.publisher = plugins.pubsub.Publisher(self, yml) if self.pubsub_host else None
+        self.rule_concurrency = int(yml.get("rule_concurrency", DEFAULT_RULE_CONCURRENCY))
+        self.rule_timeout = int(yml.get("rule_timeout", DEFAULT_RULE_TIMEOUT))
+        self.batch_searches = bool(yml.get("batch_searches", False))
+        self.incremental_rules = bool(yml.get("incremental_rules", False))
+        self.composite_rules = bool(yml.get("composite_rules", False))
+        self.composite_page_size = int(yml.get("composite_page_size", DEFAULT_COMPOSITE_PAGE_SIZE))
+        self.incremental_bucket = int(yml.get("incremental_bucket", DEFAULT_INCREMENTAL_BUCKET))
+        self.incremental_lag = int(yml.get("incremental_lag", DEFAULT_INCREMENTAL_LAG))
+        self.rule_stats = {}  # Per-rule timing and result counts, keyed by rule ID
+        self.cycle_stats = {}  # Timing for the latest background cycle
+        self.index_cache_ttl = int(yml.get("index_cache_ttl", DEFAULT_INDEX_CACHE_TTL))
+        self.index_cache = None  # (UTC date, expiry, index names) of the latest index lookup
+        self.es_requests = 0  # Running count of requests made to ES
 
-        # Create table if not there yet
-        new_db = False
-        if not self.sqlite.table_exists("rules"):
+        # Create tables if not there yet, and bring older databases up to date
+        new_db = not self.sqlite.table_exists("rules")
+        if new_db:
             print(f"Database file {self.database_filepath} is empty, initializing tables")
-            self.sqlite.run(plugins.db_create.CREATE_DB_RULES)
-            self.sqlite.run(plugins.db_create.CREATE_DB_LISTS)
-            self.sqlite.run(plugins.db_create.CREATE_DB_AUDIT)
-        if not self.sqlite.table_exists("santalist"):
-            print(f"Making santa's list")
-            self.sqlite.run(plugins.db_create.CREATE_DB_SANTAS_LIST)
+        plugins.migrations.migrate(self.sqlite)
+        self.auditlog = plugins.auditlog.AuditLog(self, yml)  # Archives old audit log entries
+        self.santa_list = plugins.santalist.SantaList(self)  # Past infractions of offenders, cached as they are looked up
+
+        # Every change to the lists below gets a sequence number in the change log
+        self.changelog = plugins.changelog.ChangeLog(self, int(yml.get("changelog_size", DEFAULT_CHANGELOG_SIZE)))
+
+        # Expiry of list entries is scheduled as the lists below are loaded and added to
+        self.expiry = plugins.expiry.ExpiryScheduler(self)
 
         # Init and fetch existing blocks and allows
         self.block_list = plugins.lists.List(self, "block")
         self.allow_list = plugins.lists.List(self, "allow")
+        self.blocksets = plugins.blockset.BlockSetCache(self)  # Compiled block sets for exporting to clients
 
         # Seed new DB with default allows if needed
         if new_db:
@@ -77,6 +127,26 @@ class BlockyConfiguration:
                     host="*",
                 )
 
+    async def resolve_indices(self, days: int) -> typing.List[str]:
+        """Returns the names of the existing indices for the past $days days, newest first.
+        Results are cached until the TTL runs out or the UTC date changes, whichever comes first."""
+        now = datetime.datetime.utcnow()
+        today = now.strftime("%Y-%m-%d")
+        if self.index_cache:
+            cache_date, cache_expires, indices = self.index_cache
+            if cache_date == today and cache_expires > time.time():
+                return indices
+        indices = []
+        for i in range(0, days):
+            index_name = now.strftime(self.index_pattern)
+            if index_name not in indices:
+                self.es_requests += 1
+                if await self.elasticsearch.indices.exists(index=index_name):
+                    indices.append(index_name)
+            now -= datetime.timedelta(days=1)
+        self.index_cache = (today, time.time() + self.index_cache_ttl, indices)
+        return indices
+
     async def test_es(self):
         i = await self.elasticsearch.info()
         es_major = int(i["version"]["number"].split(".")[0])
@@ -19,7 +19,7 @@
 # Definitions for SQLite tables used in Blocky/4
 
 CREATE_DB_RULES = """
-CREATE TABLE "rules" (
+CREATE TABLE IF NOT EXISTS "rules" (
 	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
 	"description"	TEXT NOT NULL,
 	"aggtype"	TEXT NOT NULL,
@@ -30,19 +30,26 @@ CREATE TABLE "rules" (
 """
 
 CREATE_DB_LISTS = """
-CREATE TABLE "lists" (
+CREATE TABLE IF NOT EXISTS "lists" (
 	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
 	"type" TEXT NOT NULL,
 	"ip"	TEXT NOT NULL,
 	"reason"	TEXT NOT NULL,
 	"timestamp"	INTEGER NOT NULL,
 	"expires"	INTEGER NOT NULL,
-	"host"	TEXT NOT NULL
+	"host"	TEXT NOT NULL,
+	"net_start"	BLOB,
+	"net_end"	BLOB,
+	"net_prefix"	INTEGER
 );
 """
 
+# Parsed network of each list entry: first and last address as packed (big-endian) bytes, and the prefix length.
+# Added to lists tables created before these columns existed, see plugins.migrations
+LISTS_NETWORK_COLUMNS = {"net_start": "BLOB", "net_end": "BLOB", "net_prefix": "INTEGER"}
+
 CREATE_DB_AUDIT = """
-CREATE TABLE "auditlog" (
+CREATE TABLE IF NOT EXISTS "auditlog" (
 	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
 	"ip"	TEXT NOT NULL,
 	"event"	TEXT NOT NULL,
@@ -51,7 +58,7 @@ CREATE TABLE "auditlog" (
 """
 
 CREATE_DB_SANTAS_LIST = """
-CREATE TABLE "santalist" (
+CREATE TABLE IF NOT EXISTS "santalist" (
 	"ip"	     TEXT NOT NULL PRIMARY KEY UNIQUE,
 	"niceness"   INTEGER NOT NULL,
 	"updated"    INTEGER NOT NULL,
@@ -59,3 +66,51 @@ CREATE TABLE "santalist" (
 );
 """
 
+
+CREATE_INDEX_LISTS_EXPIRES = """
+CREATE INDEX IF NOT EXISTS "lists_expires" ON "lists" ("expires");
+"""
+
+CREATE_INDEX_LISTS_TYPE_IP = """
+CREATE INDEX IF NOT EXISTS "lists_type_ip" ON "lists" ("type", "ip");
+"""
+
+CREATE_INDEX_SANTALIST_TOKEN = """
+CREATE INDEX IF NOT EXISTS "santalist_token" ON "santalist" ("token");
+"""
+
+CREATE_INDEX_RULES_PARAMETERS = """
+CREATE INDEX IF NOT EXISTS "rules_parameters" ON "rules" ("description", "aggtype", "limit", "duration", "filters");
+"""
+
+CREATE_INDEX_AUDITLOG_TIMESTAMP = """
+CREATE INDEX IF NOT EXISTS "auditlog_timestamp" ON "auditlog" ("timestamp");
+"""
+
+CREATE_DB_CHANGELOG = """
+CREATE TABLE IF NOT EXISTS "changelog" (
+	"seq"	INTEGER NOT NULL PRIMARY KEY,
+	"action"	TEXT NOT NULL,
+	"type"	TEXT NOT NULL,
+	"ip"	TEXT NOT NULL,
+	"reason"	TEXT,
+	"timestamp"	INTEGER NOT NULL,
+	"expires"	INTEGER NOT NULL,
+	"host"	TEXT NOT NULL
+);
+"""
+
+CREATE_DB_CHANGELOG_STATE = """
+CREATE TABLE IF NOT EXISTS "changelog_state" (
+	"id"	INTEGER NOT NULL PRIMARY KEY CHECK ("id" = 0),
+	"reserved"	INTEGER NOT NULL
+);
+"""
+
+CREATE_DB_SCHEMA_VERSION = """
+CREATE TABLE IF NOT EXISTS "schema_version" (
+	"version"	INTEGER NOT NULL PRIMARY KEY,
+	"description"	TEXT NOT NULL,
+	"applied"	INTEGER NOT NULL
+);
+"""
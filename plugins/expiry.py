@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import heapq
+import itertools
+import time
+import typing
+import plugins.configuration
+import plugins.lists
+
+""" Expiry scheduler for allow/block list entries """
+
+COMPACT_THRESHOLD = 10000  # Don't bother compacting heaps smaller than this
+MAX_SLEEP = 3600  # Never sleep longer than this, in case the clock jumps
+TEMPORARY_ALLOW_SECONDS = 600  # Expired blocks are allow-listed for this long, so hosts flush them
+
+
+class ExpiryScheduler:
+    """Keeps every expiring list entry in a min-heap ordered by expiry time, so finding what is due is O(1) and
+    expiring k entries is O(k log n). Entries removed from their list before expiring are not taken out of the heap
+    right away; they are skipped when popped, and the heap is compacted whenever it has doubled in size."""
+
+    def __init__(self, state: "plugins.configuration.BlockyConfiguration"):
+        self.state = state
+        self.heap: typing.List[typing.Tuple[int, int, "plugins.lists.List", "plugins.lists.IPEntry"]] = []
+        self.counter = itertools.count()  # Tie-breaker, so entries with the same expiry time are never compared
+        self.compact_at = COMPACT_THRESHOLD  # Heap size at which to next drop stale items
+        self.wakeup: typing.Optional[asyncio.Event] = None
+
+    def schedule(self, entry_list: "plugins.lists.List", entry: "plugins.lists.IPEntry"):
+        """Schedules an entry for removal from its list once it expires"""
+        if entry["expires"] == -1:
+            return  # never expires
+        if len(self.heap) >= self.compact_at:
+            self.compact()
+        item = (entry["expires"], next(self.counter), entry_list, entry)
+        heapq.heappush(self.heap, item)
+        if self.heap[0] is item and self.wakeup:  # Due before anything else, so the sleeping run() needs to know
+            self.wakeup.set()
+
+    def schedule_many(self, entry_list: "plugins.lists.List", entries: typing.Iterable["plugins.lists.IPEntry"]):
+        """Schedules a batch of entries, e.g. a whole list loaded at startup, with a single heapify"""
+        self.heap.extend(
+            (entry.expires, next(self.counter), entry_list, entry) for entry in entries if entry.expires != -1
+        )
+        heapq.heapify(self.heap)
+        self.compact_at = max(self.compact_at, 2 * len(self.heap))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def compact(self):
+        """Drops heap items whose entry is no longer on its list. The next compaction happens once the heap has
+        doubled in size again, so the cost of compacting is amortized over the pushes in between."""
+        self.heap = [item for item in self.heap if item[3] in item[2]]
+        heapq.heapify(self.heap)
+        self.compact_at = max(COMPACT_THRESHOLD, 2 * len(self.heap))
+
+    def next_due(self) -> typing.Optional[int]:
+        """Returns the expiry time of the next entry due, if any"""
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: int) -> typing.Iterator[typing.Tuple["plugins.lists.List", "plugins.lists.IPEntry"]]:
+        """Pops and yields every entry that has expired by $now and is still on its list"""
+        while self.heap and self.heap[0][0] < now:
+            _expires, _seq, entry_list, entry = heapq.heappop(self.heap)
+            if entry in entry_list:
+                yield entry_list, entry
+
+    def expire(self, now: int = None) -> int:
+        """Removes all expired entries from the allow and block lists. Returns the number of entries removed."""
+        now = now or int(time.time())
+        expired = 0
+        for entry_list, entry in list(self.pop_due(now)):
+            if entry not in entry_list:  # Could have been removed as a conflict of the temporary allow entry below
+                continue
+            print(f"Expiring {entry_list.type} rule for {entry['ip']}")
+            entry_list.remove(entry)
+            expired += 1
+            if entry_list is self.state.block_list:
+                # Try adding a temporary whitelist entry to flush on hosts
+                try:
+                    self.state.allow_list.add(
+                        ip=entry["ip"],
+                        timestamp=now,
+                        expires=now + TEMPORARY_ALLOW_SECONDS,
+                        reason="Temporary allow-listed by BLocky4 to unblock IP due to block expiring",
+                        host=plugins.configuration.DEFAULT_HOST_BLOCK,
+                        force=False,
+                    )
+                except plugins.lists.BlockListException:
+                    pass  # If it conflicts, it should already be unblocked, so we don't care.
+        return expired
+
+    async def run(self):
+        """Expires entries as they fall due, sleeping until the next one is due or a sooner one is scheduled"""
+        self.wakeup = asyncio.Event()
+        while True:
+            self.expire()
+            next_due = self.next_due()
+            # Entries expire once the clock has passed their expiry time, hence the extra second
+            timeout = MAX_SLEEP if next_due is None else min(MAX_SLEEP, max(0, next_due + 1 - time.time()))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import typing
+import plugins.radix
+
+""" In-memory index of the iptables rules uploaded by blocky clients """
+
+MAX_AGE = 86400  # Rules from hosts that have not uploaded for this long are considered stale
+
+
+class HostRules(typing.NamedTuple):
+    timestamp: int  # When the host last uploaded its rules
+    digest: str  # Digest of the uploaded rules, to tell whether a re-upload changed anything
+    keys: typing.List[typing.Tuple[int, int, int]]  # Parsed source network of each rule, in upload order
+    rules: typing.List[dict]  # The rules as uploaded, plus the name of the host they came from
+
+
+class IPTablesIndex:
+    """Keeps the latest iptables upload of every client host, with the source network of each rule parsed once on
+    upload and indexed in a single radix tree across all hosts. Searching for an address or network is then one tree
+    query rather than a scan of every rule of every host. A re-upload replaces all of that host's rules in one go:
+    the new rules are parsed before anything is touched, so a bad upload leaves the old rules in place. As clients
+    re-upload their rules on a schedule whether they changed or not, each upload is keyed by a digest, and a
+    re-upload with the same digest only refreshes the host's timestamp."""
+
+    def __init__(self):
+        self.hosts: typing.Dict[str, HostRules] = {}
+        self.index = plugins.radix.RadixTree()
+
+    def parse(self, hostname: str, rules: typing.List[dict]) -> typing.Tuple[list, list]:
+        """Parses the source network of every rule, returning the keys and the rules to store"""
+        keys = []
+        stored = []
+        for rule in rules:
+            assert isinstance(rule, dict) and isinstance(rule.get("source"), str), \
+                "Each iptables entry must have a source address!"
+            keys.append(plugins.radix.parse(rule["source"]))
+            stored.append(dict(rule, hostname=hostname))
+        return keys, stored
+
+    @staticmethod
+    def digest(rules: typing.List[dict]) -> str:
+        """Returns a digest of a set of rules, for clients that do not send one of their own"""
+        return hashlib.sha256(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def refresh(self, hostname: str, timestamp: int, digest: str) -> bool:
+        """Marks a host as having re-uploaded the rules it already has, if the digest matches what it uploaded last.
+        Returns False if the host has to upload its rules in full."""
+        host = self.hosts.get(hostname)
+        if host is None or host.digest != digest:
+            return False
+        self.hosts[hostname] = host._replace(timestamp=timestamp)
+        return True
+
+    def replace(self, hostname: str, timestamp: int, rules: typing.List[dict], digest: str = None):
+        """Replaces all rules of a host with a newly uploaded set, unless it is the same set as last time"""
+        digest = digest or self.digest(rules)
+        if self.refresh(hostname, timestamp, digest):
+            return
+        keys, stored = self.parse(hostname, rules)
+        self.drop(hostname)
+        for key, rule in zip(keys, stored):
+            self.index.insert(key, rule)
+        self.hosts[hostname] = HostRules(timestamp, digest, keys, stored)
+
+    def drop(self, hostname: str):
+        """Removes all rules of a host from the index"""
+        old = self.hosts.pop(hostname, None)
+        if old:
+            for key, rule in zip(old.keys, old.rules):
+                self.index.remove(key, rule)
+
+    def prune(self, now: int):
+        """Forgets hosts that have not uploaded anything for MAX_AGE seconds"""
+        for hostname in [hostname for hostname, host in self.hosts.items() if host.timestamp <= now - MAX_AGE]:
+            self.drop(hostname)
+
+    def search(self, network, now: int, limit: int = 0) -> typing.List[dict]:
+        """Returns the rules (of hosts that are not stale) whose source overlaps the given network"""
+        self.prune(now)
+        return self.index.overlapping(network, limit)
+
+    def __len__(self):
+        return len(self.index)
@@ -15,16 +15,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import netaddr
+import socket
+import sys
 import time
 import plugins.configuration
+import plugins.metrics
+import plugins.radix
 import typing
-import aiohttp
-import asyncio
 
 """ Block- and Allow-list handlers """
 
 
+ADDRESS_FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+SORT_FIELDS = ("timestamp", "expires", "ip")  # Fields that list entries can be ordered (and paged) by
+LOAD_STATEMENT = (
+    "SELECT ip, reason, timestamp, expires, host, net_start, net_prefix FROM lists WHERE type = ? ORDER BY id"
+)
+
+LIST_CHANGES = plugins.metrics.counter(
+    "blocky_list_changes_total", "Entries added to or removed from the lists", ("list", "action")
+)
+LIST_CONFLICTS = plugins.metrics.counter(
+    "blocky_list_conflicts_total", "Additions refused for conflicting with an existing entry", ("list",)
+)
+LIST_ADD_DURATION = plugins.metrics.histogram(
+    "blocky_list_add_duration_seconds", "Time taken to add an entry to a list, conflict checks included", ("list",)
+)
+
+
 class BlockListException(BaseException):
     def __init__(self, string: str):
         self.string = string
@@ -33,28 +53,193 @@ class BlockListException(BaseException):
         return self.string
 
 
-class IPEntry(dict):
+class IPEntry:
+    """A single allow/block list entry. The network is kept as packed integers rather than a netaddr object, and
+    reason/host strings are interned, as most entries share them with many others. The original IP string is only
+    kept if it differs from the canonical form of the network. Entries behave like read-only dicts for the fields
+    below, and are turned into real dicts only when serialized at the API boundary."""
+
+    __slots__ = ("version", "first", "prefixlen", "_ip", "timestamp", "expires", "reason", "host")
+    FIELDS = ("ip", "timestamp", "expires", "reason", "host")
+
     def __init__(self, ip: str, timestamp: int, expires: int, reason: str = None, host: str = "*"):
-        dict.__init__(self, ip=ip, timestamp=timestamp, expires=expires, reason=reason, host=host)
-        self.network = netaddr.IPNetwork(ip)
+        self.version, self.first, self.prefixlen = plugins.radix.parse(ip)
+        self._ip = None
+        if ip != self.ip:
+            self._ip = ip
+        self.timestamp = timestamp
+        self.expires = expires
+        self.reason = sys.intern(reason) if reason else reason
+        self.host = sys.intern(host) if host else host
+
+    @classmethod
+    def from_columns(
+        cls, ip: str, net_start: bytes, net_prefix: int, timestamp: int, expires: int, reason: str, host: str
+    ) -> "IPEntry":
+        """Builds an entry from a database row, using its stored network columns instead of parsing the IP"""
+        entry = cls.__new__(cls)
+        entry.version = 4 if len(net_start) == 4 else 6
+        entry.first = int.from_bytes(net_start, "big")
+        entry.prefixlen = net_prefix
+        entry._ip = None
+        if ip != entry.ip:
+            entry._ip = ip
+        entry.timestamp = timestamp
+        entry.expires = expires
+        entry.reason = sys.intern(reason) if reason else reason
+        entry.host = sys.intern(host) if host else host
+        return entry
+
+    def network_columns(self) -> dict:
+        """The entry's network as stored in the net_start, net_end and net_prefix columns of the lists table"""
+        bits = plugins.radix.ADDRESS_BITS[self.version]
+        last = self.first | ((1 << (bits - self.prefixlen)) - 1)
+        return {
+            "net_start": self.first.to_bytes(bits // 8, "big"),
+            "net_end": last.to_bytes(bits // 8, "big"),
+            "net_prefix": self.prefixlen,
+        }
+
+    @property
+    def ip(self) -> str:
+        """The IP/CIDR as originally given"""
+        if self._ip is not None:
+            return self._ip
+        bits = plugins.radix.ADDRESS_BITS[self.version]
+        address = socket.inet_ntop(ADDRESS_FAMILIES[self.version], self.first.to_bytes(bits // 8, "big"))
+        if self.prefixlen == bits:
+            return address
+        return f"{address}/{self.prefixlen}"
+
+    @property
+    def key(self) -> typing.Tuple[int, int, int]:
+        """The (version, network address, prefix length) of this entry, as used by List and the radix index"""
+        return self.version, self.first, self.prefixlen
+
+    @property
+    def network(self) -> netaddr.IPNetwork:
+        """The entry as a netaddr object, built on demand"""
+        return netaddr.IPNetwork(self.ip)
+
+    def __getitem__(self, key: str):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def to_dict(self) -> dict:
+        return {"ip": self.ip, "timestamp": self.timestamp, "expires": self.expires, "reason": self.reason, "host": self.host}
+
+    def __repr__(self):
+        return f"IPEntry({self.to_dict()!r})"
+
+
+def sort_key(field: str, entry: IPEntry) -> tuple:
+    """Returns the key that entries are ordered by for a given sort field. The entry's network is always part of
+    it, so keys are unique within a list and can be used as paging cursors."""
+    if field == "ip":
+        return entry.key
+    return (getattr(entry, field),) + entry.key
+
+
+def seek(entries: typing.List[IPEntry], field: str, target: tuple) -> int:
+    """Binary search: returns the position of the first entry whose sort key is not less than $target"""
+    low, high = 0, len(entries)
+    while low < high:
+        middle = (low + high) // 2
+        if sort_key(field, entries[middle]) < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def normalize(ip: typing.Union[str, netaddr.IPNetwork]) -> typing.Tuple[int, int, int]:
+    """Returns the canonical (version, network address, prefix length) form of an IP or network, which is what
+    entries are keyed on. 10.0.5.0/16 and 10.0.0.0/16 both normalize to (4, 167772160, 16)."""
+    return plugins.radix.to_key(ip)
 
 
 class List:
     def __init__(self, state: "plugins.configuration.BlockyConfiguration", list_type: str = "block"):
         self.type = list_type
-        self.list = []
+        self.list: typing.Dict[tuple, IPEntry] = {}  # Entries keyed by normalized CIDR, in insertion order
+        self.hosts: typing.Dict[str, typing.Dict[tuple, IPEntry]] = {}  # Same entries, grouped by host
+        self.index = plugins.radix.RadixTree()  # Prefix index of self.list, for membership and conflict checks
+        self._by_time: typing.Optional[typing.List[IPEntry]] = None  # All entries by timestamp, once first needed
+        self.version = 0  # Bumped on every change to the list
+        self.snapshots: typing.Dict[int, typing.Tuple[int, str]] = {}  # Serialized entries, by limit: (version, JSON)
+        self.orderings: typing.Dict[str, typing.Tuple[int, typing.List[IPEntry]]] = {}  # Other sort orders, by field
         self.state = state
+        self.load()
 
-        for entry in state.sqlite.fetch("lists", type=list_type, limit=0):
-            self.list.append(
-                IPEntry(
-                    ip=entry["ip"],
-                    timestamp=entry["timestamp"],
-                    expires=entry["expires"],
-                    reason=entry["reason"],
-                    host=entry.get("host", "*"),
-                )
-            )
+    def load(self):
+        """Loads the list from the database in bulk: rows are read as plain tuples through a single cursor, and
+        entries are built straight from the stored network columns. Only what membership and conflict checks need
+        (the entries by network and host, and the prefix index) is built here; the timestamp order is sorted the
+        first time something asks for it."""
+        list_entries = self.list
+        hosts = self.hosts
+        index = self.index
+        for ip, reason, timestamp, expires, host, net_start, net_prefix in self.state.sqlite.iterate(
+            LOAD_STATEMENT, self.type
+        ):
+            if net_start is None:  # Not migrated, e.g. an unparseable IP; this raises if it really makes no sense
+                entry = IPEntry(ip, timestamp, expires, reason, host or "*")
+            else:
+                entry = IPEntry.from_columns(ip, net_start, net_prefix, timestamp, expires, reason, host or "*")
+            key = entry.key
+            existing = list_entries.get(key)
+            if existing is not None:  # Duplicate rows for the same network, the newest one wins
+                self._unstore(key, existing)
+            list_entries[key] = entry
+            host_entries = hosts.get(entry.host)
+            if host_entries is None:
+                host_entries = hosts[entry.host] = {}
+            host_entries[key] = entry
+            index.insert(key, entry)
+        self.version += 1
+        self.state.expiry.schedule_many(self, list_entries.values())
+
+    @property
+    def by_time(self) -> typing.List[IPEntry]:
+        """All entries, ordered by timestamp. Sorted on first use, and kept in order from then on."""
+        if self._by_time is None:
+            self._by_time = sorted(self.list.values(), key=lambda entry: sort_key("timestamp", entry))
+        return self._by_time
+
+    def _store(self, entry: IPEntry):
+        """Adds an entry to the in-memory list and its indexes"""
+        key = entry.key
+        existing = self.list.get(key)
+        if existing is not None:  # Duplicate rows for the same network, the newest one wins
+            self._unstore(key, existing)
+        self.list[key] = entry
+        self.hosts.setdefault(entry["host"], {})[key] = entry
+        self.index.insert(key, entry)
+        by_time = self._by_time
+        if by_time is not None:
+            time_key = sort_key("timestamp", entry)
+            if not by_time or sort_key("timestamp", by_time[-1]) < time_key:
+                by_time.append(entry)  # The common case, as new entries are timestamped now
+            else:
+                by_time.insert(seek(by_time, "timestamp", time_key), entry)
+        self.version += 1
+
+    def _unstore(self, key: tuple, entry: IPEntry):
+        """Removes an entry from the in-memory list and its indexes"""
+        del self.list[key]
+        host_entries = self.hosts.get(entry["host"])
+        if host_entries is not None:
+            host_entries.pop(key, None)
+            if not host_entries:
+                del self.hosts[entry["host"]]
+        self.index.remove(key, entry)
+        if self._by_time is not None:
+            del self._by_time[seek(self._by_time, "timestamp", sort_key("timestamp", entry))]
+        self.version += 1
 
     def add(
         self,
@@ -66,6 +251,7 @@ class List:
         force: bool = False,
     ) -> None:
         """Add an IP or IP Range to the allow/block list"""
+        started = time.perf_counter()
         now = int(time.time())
         if not timestamp:
             timestamp = now
@@ -77,39 +263,36 @@ class List:
             entry = ip
 
         # Check if IP address conflicts with an entry on the allow list
-        to_remove = []
-        for network in self.state.allow_list:
-            if entry.network in network.network or network.network in entry.network:
-                if force:
-                    to_remove.append(network)
-                else:
-                    raise BlockListException(
-                        f"IP entry {ip} conflicts with allow list entry {network.network}. "
-                        "Please address this or use force=true to override."
-                    )
+        allow_conflicts = self.state.allow_list.overlapping(entry.key)
+        if allow_conflicts and not force:
+            LIST_CONFLICTS.inc(list=self.type)
+            raise BlockListException(
+                f"IP entry {ip} conflicts with allow list entry {allow_conflicts[0].network}. "
+                "Please address this or use force=true to override."
+            )
 
         # Check if IP address conflicts with an entry on the block list
-        for network in self.state.block_list:
-            if entry.network in network.network or network.network in entry.network:
-                if force:
-                    to_remove.append(network)
-                else:
-                    raise BlockListException(
-                        f"IP entry {ip} conflicts with block list entry {network.network}. "
-                        "Please address this or use force=true to override."
-                    )
+        block_conflicts = self.state.block_list.overlapping(entry.key)
+        if block_conflicts and not force:
+            LIST_CONFLICTS.inc(list=self.type)
+            raise BlockListException(
+                f"IP entry {ip} conflicts with block list entry {block_conflicts[0].network}. "
+                "Please address this or use force=true to override."
+            )
 
         # If force=true and a conflict was found, remove the conflicting entry
-        for d_entry in to_remove:
+        for d_entry in allow_conflicts:
             self.state.allow_list.remove(d_entry)
+        for d_entry in block_conflicts:
             self.state.block_list.remove(d_entry)
 
         # Now add the block
-        self.list.append(entry)
-        entry["type"] = self.type
+        self._store(entry)
+        self.state.expiry.schedule(self, entry)
+        self.state.changelog.record("add", self.type, entry)
         self.state.sqlite.insert(
             "lists",
-            entry,
+            dict(entry.to_dict(), type=self.type, **entry.network_columns()),
         )
 
         # Add to audit log
@@ -118,38 +301,21 @@ class List:
             {"ip": ip, "timestamp": int(time.time()), "event": f"IP {ip} added to the {self.type} list: {reason}"},
         )
 
-        # Add pubsubbing to the main loop
-        if self.state.pubsub_host:
-            loop = asyncio.get_event_loop()
-            loop.create_task(self.pubsub(entry))
-
-    async def pubsub(self, entry):
-        js = {
-            self.type: entry
-        }
-        api_url = f"{self.state.pubsub_host}/blocky/{self.type}"
-        try:
-            auth = None
-            if self.state.pubsub_user:
-                auth = aiohttp.BasicAuth(self.state.pubsub_user, self.state.pubsub_password)
-            timeout = aiohttp.ClientTimeout(total=10)
-            async with aiohttp.request("POST", api_url, json=js, timeout=timeout, auth=auth) as resp:
-                response = await resp.text()
-                assert resp.status == 202, f"pyPubSub responded: {response}"
-        except Exception as e:
-            print(f"Could not send payload to {api_url}: {e}")
+        # Queue the addition for publishing to pubsub
+        if self.state.publisher:
+            self.state.publisher.publish(self.type, entry)
+        LIST_CHANGES.inc(list=self.type, action="add")
+        LIST_ADD_DURATION.observe(time.perf_counter() - started, list=self.type)
 
     def remove(self, entry: typing.Union[str, IPEntry]):
         """Removes an IP/CIDR from the list"""
         if isinstance(entry, str):  # We want an IPEntry object. If given just an IP, find the object
-            for x_entry in self.list:
-                if x_entry["ip"] == entry:
-                    entry = x_entry
-                    break
+            entry = self.get(entry)
         # Only try to remove if we have an entry in our list
-        if entry and isinstance(entry, IPEntry) and entry in self.list:
+        if entry and isinstance(entry, IPEntry) and entry in self:
             self.state.sqlite.delete("lists", type=self.type, ip=entry['ip'])
-            self.list.remove(entry)
+            self._unstore(entry.key, entry)
+            self.state.changelog.record("remove", self.type, entry)
             # Add to audit log
             self.state.sqlite.insert(
                 "auditlog",
@@ -159,7 +325,87 @@ class List:
                     "event": f"IP {entry['ip']} removed from the {self.type} list.",
                 },
             )
+            LIST_CHANGES.inc(list=self.type, action="remove")
+
+    def get(self, ip: str) -> typing.Optional[IPEntry]:
+        """Returns the entry for exactly this IP/CIDR, if any"""
+        try:
+            return self.list.get(normalize(ip))
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            return None
+
+    def by_host(self, host: str) -> typing.List[IPEntry]:
+        """Returns all entries that apply specifically to the given host (use "*" for entries that apply to all hosts)"""
+        return list(self.hosts.get(host, {}).values())
+
+    def latest(self, count: int) -> typing.List[IPEntry]:
+        """Returns the $count most recently added entries (by timestamp), newest first"""
+        return self.by_time[:-count - 1:-1] if count else []
+
+    def snapshot(self, limit: int = 0) -> str:
+        """Returns the entries as a serialized JSON array: all of them in list order, or just the $limit latest ones.
+        The result is cached until the list changes, so repeated calls for an unchanged list cost nothing."""
+        cached = self.snapshots.get(limit)
+        if cached and cached[0] == self.version:
+            return cached[1]
+        entries = self.latest(limit) if limit else self
+        body = json.dumps([entry.to_dict() for entry in entries])
+        self.snapshots[limit] = (self.version, body)
+        return body
+
+    def ordered(self, field: str = "timestamp") -> typing.List[IPEntry]:
+        """Returns all entries in ascending order of the given sort field. The timestamp order is kept up to date
+        as entries come and go; other orders are sorted on demand and cached until the list changes."""
+        if field == "timestamp":
+            return self.by_time
+        cached = self.orderings.get(field)
+        if cached and cached[0] == self.version:
+            return cached[1]
+        entries = sorted(self.list.values(), key=lambda entry: sort_key(field, entry))
+        self.orderings[field] = (self.version, entries)
+        return entries
+
+    def walk(
+        self, field: str = "timestamp", descending: bool = False, after: tuple = None, entries: typing.List[IPEntry] = None
+    ) -> typing.Iterator[IPEntry]:
+        """Yields entries in order of the given sort field, starting right after the entry with sort key $after
+        (a paging cursor) if given. Walks over $entries, a list previously returned by ordered(), if given."""
+        if entries is None:
+            entries = self.ordered(field)
+        if descending:
+            start = seek(entries, field, after) if after is not None else len(entries)
+            for position in range(start - 1, -1, -1):
+                yield entries[position]
+        else:
+            start = seek(entries, field, after) if after is not None else 0
+            if start < len(entries) and sort_key(field, entries[start]) == after:
+                start += 1
+            for position in range(start, len(entries)):
+                yield entries[position]
+
+    def covering(self, network: typing.Union[str, netaddr.IPNetwork, netaddr.IPAddress]) -> typing.List[IPEntry]:
+        """Returns all entries that contain (or equal) the given IP or network"""
+        return self.index.covering(network)
+
+    def covered(self, network: typing.Union[str, netaddr.IPNetwork, netaddr.IPAddress]) -> typing.List[IPEntry]:
+        """Returns all entries that lie within (or equal) the given network"""
+        return self.index.covered(network)
+
+    def overlapping(self, network: typing.Union[str, netaddr.IPNetwork, netaddr.IPAddress]) -> typing.List[IPEntry]:
+        """Returns all entries that either contain or lie within the given network"""
+        return self.index.overlapping(network)
+
+    def longest_match(self, network: typing.Union[str, netaddr.IPNetwork, netaddr.IPAddress]) -> typing.Optional[IPEntry]:
+        """Returns the most specific entry containing the given IP or network, if any"""
+        return self.index.longest_match(network)
+
+    def __contains__(self, entry: IPEntry) -> bool:
+        """Returns True if this exact entry object is on the list"""
+        return self.list.get(entry.key) is entry
+
+    def __len__(self):
+        return len(self.list)
 
     def __iter__(self):
-        for entry in self.list:
+        for entry in self.list.values():
             yield entry
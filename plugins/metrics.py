@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import contextlib
+import functools
+import math
+import time
+import typing
+
+""" Counters, gauges and latency histograms, exposed in the Prometheus text format.
+
+Metrics are registered once, at import time, by the module that updates them. Each one keeps a single value (or,
+for histograms, one count per bucket plus a sum) per combination of label values, so the memory used only grows with
+the number of label combinations seen, never with the number of observations.
+"""
+
+# Default histogram buckets, in seconds: from sub-millisecond lookups up to rule searches hitting their deadline
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self.values: typing.Dict[tuple, typing.Any] = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        """Forgets the values for every combination of labels that matches the given ones, e.g. for a deleted rule"""
+        match = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        for key in [key for key in self.values if all(key[i] == value for i, value in match)]:
+            del self.values[key]
+
+    def format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> typing.Iterator[str]:
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{self.format_labels(key)} {_format_value(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts observations into fixed buckets. Each combination of labels costs one list of len(buckets) + 2
+    numbers: the (non-cumulative) count per bucket, the number of observations above the highest bucket, and the sum
+    of all observations."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long the body of a with statement takes, whether or not it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> typing.Iterator[str]:
+        for key, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{self.format_labels(key, le)} {cumulative}"
+            yield f"{self.name}_sum{self.format_labels(key)} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{self.format_labels(key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: typing.Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Adds a metric. Registering a metric by the same name again replaces the earlier one."""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labels: typing.Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: typing.Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+
+def histogram(
+    name: str, documentation: str, labels: typing.Sequence[str] = (), buckets: typing.Sequence[float] = LATENCY_BUCKETS
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+HTTP_REQUESTS = counter(
+    "blocky_http_requests_total", "HTTP API requests handled, by endpoint and outcome", ("endpoint", "outcome")
+)
+HTTP_DURATION = histogram("blocky_http_request_duration_seconds", "Time taken by HTTP API handlers", ("endpoint",))
+
+
+def instrument(endpoint: str, handler: typing.Callable) -> typing.Callable:
+    """Wraps an API endpoint handler, so that its latency and outcome (ok or error) are recorded"""
+
+    @functools.wraps(handler)
+    async def instrumented(state, request, formdata):
+        outcome = "error"
+        try:
+            with HTTP_DURATION.time(endpoint=endpoint):
+                response = await handler(state, request, formdata)
+            outcome = "ok"
+            return response
+        finally:
+            HTTP_REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+
+    return instrumented
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import netaddr
+import time
+import typing
+import plugins.db_create
+import plugins.lists
+import plugins.storage
+
+""" Versioned schema migrations for the Blocky/4 database """
+
+
+def add_network_columns(db: "plugins.storage.BlockyDB"):
+    """Adds the network columns to a lists table that predates them, and fills them in for rows that lack them"""
+    columns = {row["name"] for row in db.query('PRAGMA table_info("lists")')}
+    for name, column_type in plugins.db_create.LISTS_NETWORK_COLUMNS.items():
+        if name not in columns:
+            db.run(f'ALTER TABLE "lists" ADD COLUMN "{name}" {column_type}')
+    rows = db.query('SELECT id, ip FROM lists WHERE net_start IS NULL')
+    if not rows:
+        return
+    print(f"Storing the parsed network of {len(rows)} list entries")
+    for row in rows:
+        try:
+            columns = plugins.lists.IPEntry(row["ip"], 0, -1).network_columns()
+        except netaddr.AddrFormatError:
+            print(f"Invalid IP on list entry #{row['id']}, leaving it as is: {row['ip']}")
+            continue
+        db.runc(
+            "UPDATE lists SET net_start = ?, net_end = ?, net_prefix = ? WHERE id = ?",
+            columns["net_start"],
+            columns["net_end"],
+            columns["net_prefix"],
+            row["id"],
+        )
+    db.flush()
+
+
+class Migration(typing.NamedTuple):
+    version: int
+    description: str
+    # SQL statements to run in one transaction, or a function to call with the database for anything more involved
+    steps: typing.Union[typing.Sequence[str], typing.Callable[["plugins.storage.BlockyDB"], None]]
+
+
+# Migrations run in order, and each only once per database. Databases from before versioning have none recorded, so
+# every migration must also work on a database that already has (some of) what it adds: hence IF NOT EXISTS.
+# Never change or remove a migration once released; add a new one instead. Stick to additions (tables, indexes,
+# columns through ALTER TABLE ... ADD COLUMN), which SQLite does without rewriting existing tables.
+MIGRATIONS = [
+    Migration(
+        1,
+        "Create the rules, lists, audit log and santa's list tables",
+        [
+            plugins.db_create.CREATE_DB_RULES,
+            plugins.db_create.CREATE_DB_LISTS,
+            plugins.db_create.CREATE_DB_AUDIT,
+            plugins.db_create.CREATE_DB_SANTAS_LIST,
+        ],
+    ),
+    Migration(2, "Index list entries by expiry time", [plugins.db_create.CREATE_INDEX_LISTS_EXPIRES]),
+    Migration(3, "Create the change log table", [plugins.db_create.CREATE_DB_CHANGELOG]),
+    Migration(4, "Store the parsed network of list entries", add_network_columns),
+    Migration(
+        5,
+        "Index list entries by type and IP, santa's list by token, and rules by their parameters",
+        [
+            plugins.db_create.CREATE_INDEX_LISTS_TYPE_IP,
+            plugins.db_create.CREATE_INDEX_SANTALIST_TOKEN,
+            plugins.db_create.CREATE_INDEX_RULES_PARAMETERS,
+        ],
+    ),
+    Migration(6, "Index the audit log by time, for archiving", [plugins.db_create.CREATE_INDEX_AUDITLOG_TIMESTAMP]),
+    Migration(
+        7, "Keep track of the change log's reserved sequence numbers", [plugins.db_create.CREATE_DB_CHANGELOG_STATE]
+    ),
+]
+
+
+def current_version(db: "plugins.storage.BlockyDB") -> int:
+    """Returns the schema version of the database, 0 if no migrations have been applied yet"""
+    db.run(plugins.db_create.CREATE_DB_SCHEMA_VERSION)
+    row = db.query('SELECT MAX(version) AS version FROM "schema_version"')[0]
+    return row["version"] or 0
+
+
+def migrate(db: "plugins.storage.BlockyDB") -> int:
+    """Applies all migrations that the database does not have yet, in order. Returns the resulting schema version."""
+    version = current_version(db)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        print(f"Migrating database to schema version {migration.version}: {migration.description}")
+        record = (
+            'INSERT INTO "schema_version" (version, description, applied) VALUES (?, ?, ?)',
+            migration.version,
+            migration.description,
+            int(time.time()),
+        )
+        if callable(migration.steps):
+            migration.steps(db)
+            db.run(*record)
+        else:
+            with db.lock:
+                db.flush()
+                db.run("BEGIN")
+                try:
+                    for statement in migration.steps:
+                        db.run(statement)
+                    db.run(*record)
+                except Exception:
+                    db.run("ROLLBACK")
+                    raise
+                db.run("COMMIT")
+        version = migration.version
+    return version
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiohttp
+import asyncio
+import concurrent.futures
+import json
+import os
+import time
+import typing
+import plugins.configuration
+import plugins.lists
+import plugins.metrics
+
+""" Publisher for list changes to pyPubSub """
+
+MAX_BACKOFF = 60  # Never wait longer than this many seconds between retries
+LATENCY_WEIGHT = 0.1  # Weight of the latest publish in the moving average of publish latency
+
+PUBSUB_EVENTS = plugins.metrics.counter(
+    "blocky_pubsub_events_total", "List additions published, failed or spooled to disk", ("outcome",)
+)
+PUBSUB_DURATION = plugins.metrics.histogram("blocky_pubsub_publish_duration_seconds", "Time taken by successful POSTs")
+
+
+class Publisher:
+    """Publishes list additions to pyPubSub from a single long-lived task, over one pooled HTTP session.
+    Events are queued (up to queue_size), and up to batch_size of them are sent in a single POST to /blocky/batch,
+    waiting up to linger milliseconds after the first one for more to come in. A lone event is sent as is. Failed POSTs are retried with exponential backoff, and events that still could
+    not be delivered (or did not fit in the queue) are spooled to disk and sent again once pyPubSub is back.
+    Once pyPubSub is known to be down, events are spooled straight away, and it is only tried again (once per batch,
+    without retries) every MAX_BACKOFF seconds, so a backlog is not held up by a retry sequence per batch.
+    Spool file I/O happens on a thread of its own, off the event loop."""
+
+    def __init__(self, state: "plugins.configuration.BlockyConfiguration", yml: dict):
+        self.host = state.pubsub_host
+        self.auth = aiohttp.BasicAuth(state.pubsub_user, state.pubsub_password) if state.pubsub_user else None
+        self.queue_size = int(yml.get("pubsub_queue_size", 10000))
+        self.batch_size = int(yml.get("pubsub_batch_size", plugins.configuration.DEFAULT_PUBSUB_BATCH_SIZE))
+        self.linger = int(yml.get("pubsub_linger", plugins.configuration.DEFAULT_PUBSUB_LINGER)) / 1000
+        self.retries = int(yml.get("pubsub_retries", 5))
+        self.spool_path = yml.get("pubsub_spool", state.database_filepath + ".pubsub-spool")
+        self.queue: typing.Optional[asyncio.Queue] = None  # Created by run(), as it needs the event loop
+        self.spooler = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pubsub-spool")
+        self.down_until = 0.0  # While pyPubSub is down, events are spooled without trying it until this time
+        self.published = 0
+        self.failed = 0
+        self.spooled = 0
+        self.latency = 0.0  # Moving average of the time a successful publish takes, in seconds
+
+    def publish(self, list_type: str, entry: "plugins.lists.IPEntry"):
+        """Queues a list addition for publishing. Never blocks; if the queue is full, the event is spooled."""
+        event = {list_type: dict(entry.to_dict(), type=list_type)}
+        if self.queue is None:
+            return  # Not running (yet), e.g. when seeding a new database at startup
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.spooler.submit(self.spool, [event])
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "published": self.published,
+            "failed": self.failed,
+            "spooled": self.spooled,
+            "latency": round(self.latency, 4),
+            "down": self.down_until > time.time(),
+        }
+
+    async def in_spooler(self, function: typing.Callable, *args):
+        """Runs spool file I/O on the spool thread, which keeps writes and reads of the file in order"""
+        return await asyncio.get_running_loop().run_in_executor(self.spooler, function, *args)
+
+    def spool(self, events: typing.List[dict]):
+        """Appends undeliverable events to the spool file, as NDJSON"""
+        try:
+            with open(self.spool_path, "a") as f:
+                f.write("".join(json.dumps(event) + "\n" for event in events))
+            self.spooled += len(events)
+            PUBSUB_EVENTS.inc(len(events), outcome="spooled")
+        except OSError as e:
+            print(f"Could not spool {len(events)} pubsub event(s) to {self.spool_path}, dropping them: {e}")
+
+    def unspool(self) -> typing.List[dict]:
+        """Takes all events out of the spool file"""
+        if not os.path.exists(self.spool_path):
+            return []
+        try:
+            with open(self.spool_path) as f:
+                events = [json.loads(line) for line in f if line.strip()]
+            os.unlink(self.spool_path)
+        except (OSError, ValueError) as e:
+            print(f"Could not read pubsub spool {self.spool_path}: {e}")
+            return []
+        self.spooled -= min(self.spooled, len(events))
+        return events
+
+    async def post(self, session: aiohttp.ClientSession, events: typing.List[dict], retries: int) -> bool:
+        """Posts one event as is, or several as a batch, retrying with backoff. Returns True if pyPubSub took them."""
+        if len(events) == 1:
+            list_type = next(iter(events[0]))
+            api_url = f"{self.host}/blocky/{list_type}"
+            js = events[0]
+        else:
+            api_url = f"{self.host}/blocky/batch"
+            js = {"batch": events}
+        for attempt in range(retries + 1):
+            started = time.time()
+            try:
+                async with session.post(api_url, json=js) as resp:
+                    response = await resp.text()
+                    assert resp.status == 202, f"pyPubSub responded: {response}"
+                self.latency += LATENCY_WEIGHT * (time.time() - started - self.latency)
+                self.published += len(events)
+                PUBSUB_DURATION.observe(time.time() - started)
+                PUBSUB_EVENTS.inc(len(events), outcome="published")
+                return True
+            except Exception as e:
+                if attempt == retries:
+                    print(f"Could not send payload to {api_url}, giving up after {attempt + 1} attempts: {e}")
+                    break
+                delay = min(MAX_BACKOFF, 2 ** attempt)
+                print(f"Could not send payload to {api_url}: {e} - retrying in {delay}s")
+                await asyncio.sleep(delay)
+        self.failed += len(events)
+        PUBSUB_EVENTS.inc(len(events), outcome="failed")
+        return False
+
+    async def fill_batch(self, events: typing.List[dict]):
+        """Adds waiting events to a batch, and lingers for more to come in until it is full, unless pyPubSub is down"""
+        deadline = time.time() + self.linger
+        while len(events) < self.batch_size:
+            if not self.queue.empty():
+                events.append(self.queue.get_nowait())
+                continue
+            linger = deadline - time.time()
+            if linger <= 0 or time.time() < self.down_until:
+                break
+            try:
+                events.append(await asyncio.wait_for(self.queue.get(), linger))
+            except asyncio.TimeoutError:
+                break
+
+    async def run(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(auth=self.auth, timeout=timeout) as session:
+            # Anything spooled by a previous run goes out first
+            backlog = await self.in_spooler(self.unspool)
+            while True:
+                if not backlog and self.down_until and time.time() >= self.down_until:
+                    # Time to see whether pyPubSub is back, starting with what was spooled in the meantime
+                    backlog = await self.in_spooler(self.unspool)
+                if backlog:
+                    events, backlog = backlog[: self.batch_size], backlog[self.batch_size:]
+                else:
+                    try:
+                        wait = max(0.0, self.down_until - time.time()) if self.down_until else None
+                        events = [await asyncio.wait_for(self.queue.get(), wait)]
+                    except asyncio.TimeoutError:
+                        continue
+                    await self.fill_batch(events)
+                if time.time() < self.down_until:
+                    # pyPubSub is down: spool this batch and everything else that is waiting, in one write
+                    while not self.queue.empty():
+                        events.append(self.queue.get_nowait())
+                    await self.in_spooler(self.spool, events + backlog)
+                    backlog = []
+                    continue
+                # Once pyPubSub is known to be down, a single attempt is enough to tell whether it is back
+                retries = 0 if self.down_until else self.retries
+                if await self.post(session, events, retries):
+                    self.down_until = 0.0
+                    if not backlog:
+                        # pyPubSub is up (again), so send whatever could not be sent earlier
+                        backlog = await self.in_spooler(self.unspool)
+                else:
+                    self.down_until = time.time() + MAX_BACKOFF
+                    await self.in_spooler(self.spool, events + backlog)
+                    backlog = []
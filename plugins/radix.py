@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import typing
+import netaddr
+
+""" Path-compressed binary radix tree (PATRICIA trie) for IPv4/IPv6 prefixes.
+
+Each stored prefix is keyed on (network address as integer, prefix length). Lookups walk at most one node per
+prefix bit, so membership ("is this IP covered by anything?"), longest-prefix match and "what lies inside this
+network?" queries cost O(prefix length) rather than O(entries).
+"""
+
+ADDRESS_BITS = {4: 32, 6: 128}
+NO_CHILDREN = (None, None)  # Shared by all leaf nodes, so leaves don't need a children list of their own
+
+
+class _Node:
+    __slots__ = ("prefix", "length", "children", "items")
+
+    def __init__(self, prefix: int, length: int):
+        self.prefix = prefix
+        self.length = length
+        self.children = NO_CHILDREN
+        self.items = None  # Tuple of items stored at exactly this prefix, if any
+
+    def set_child(self, bit: int, child: typing.Optional["_Node"]):
+        if self.children is NO_CHILDREN:
+            self.children = [None, None]
+        self.children[bit] = child
+
+
+def _mask(value: int, length: int, bits: int) -> int:
+    """Masks an address down to its first $length bits"""
+    if length == 0:
+        return 0
+    return value >> (bits - length) << (bits - length)
+
+
+def parse(network: str) -> typing.Tuple[int, int, int]:
+    """Parses an IP/CIDR string straight into a (version, network address, prefix length) tree key. Plain dotted
+    quads and IPv6 addresses go through inet_pton, which is much quicker than building a netaddr object; anything
+    more exotic is left to netaddr, which raises AddrFormatError if it makes no sense either."""
+    address, _, prefix = network.partition("/")
+    try:
+        try:
+            version, packed = 4, socket.inet_pton(socket.AF_INET, address)
+        except OSError:
+            version, packed = 6, socket.inet_pton(socket.AF_INET6, address)
+        bits = ADDRESS_BITS[version]
+        length = int(prefix) if prefix else bits
+        if not 0 <= length <= bits:
+            raise ValueError(prefix)
+    except (OSError, ValueError):
+        ip = netaddr.IPNetwork(network)
+        return ip.version, ip.first, ip.prefixlen
+    return version, _mask(int.from_bytes(packed, "big"), length, bits), length
+
+
+def to_key(network: typing.Union[str, tuple, netaddr.IPNetwork, netaddr.IPAddress]) -> typing.Tuple[int, int, int]:
+    """Converts an IP/CIDR into a (version, network address, prefix length) tree key"""
+    if isinstance(network, tuple):
+        return network
+    if isinstance(network, str):
+        return parse(network)
+    if isinstance(network, netaddr.IPAddress):
+        return network.version, int(network), ADDRESS_BITS[network.version]
+    return network.version, network.first, network.prefixlen
+
+
+class RadixTree:
+    def __init__(self):
+        self.roots = {4: _Node(0, 0), 6: _Node(0, 0)}
+        self.size = 0
+
+    def insert(self, network, item) -> None:
+        """Stores an item at the given network prefix"""
+        version, value, length = to_key(network)
+        bits = ADDRESS_BITS[version]
+        node = self.roots[version]
+        while True:
+            if node.length == length:  # Every node we descend into shares our prefix, so this is an exact match
+                node.items = (node.items or ()) + (item,)
+                break
+            bit = (value >> (bits - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                leaf = _Node(value, length)
+                leaf.items = (item,)
+                node.set_child(bit, leaf)
+                break
+            common = bits - (child.prefix ^ value).bit_length()  # Number of leading bits in common
+            if child.length < common:
+                common = child.length
+            if length < common:
+                common = length
+            if common == child.length:
+                node = child
+                continue
+            # Split the edge: add a new node at the common prefix, with the old child hanging off it
+            middle = _Node(_mask(value, common, bits), common)
+            middle.set_child((child.prefix >> (bits - common - 1)) & 1, child)
+            if common == length:
+                middle.items = (item,)
+            else:
+                leaf = _Node(value, length)
+                leaf.items = (item,)
+                middle.set_child((value >> (bits - common - 1)) & 1, leaf)
+            node.set_child(bit, middle)
+            break
+        self.size += 1
+
+    def remove(self, network, item) -> bool:
+        """Removes an item from the given network prefix. Returns True if the item was found and removed."""
+        version, value, length = to_key(network)
+        bits = ADDRESS_BITS[version]
+        parent = grandparent = None
+        node = self.roots[version]
+        while node is not None and node.length < length:
+            if _mask(value, node.length, bits) != node.prefix:
+                return False
+            grandparent, parent = parent, node
+            node = node.children[(value >> (bits - node.length - 1)) & 1]
+        if node is None or node.length != length or node.prefix != value or not node.items:
+            return False
+        items = tuple(x_item for x_item in node.items if x_item is not item)
+        if len(items) == len(node.items):
+            return False
+        self.size -= 1
+        node.items = items or None
+        if not items:
+            if parent is not None:  # Never prune the roots
+                self._prune(node, parent)
+                if parent.items is None and grandparent is not None:
+                    self._prune(parent, grandparent)
+        return True
+
+    @staticmethod
+    def _prune(node: _Node, parent: _Node) -> None:
+        """Removes or splices out a node that no longer holds any items"""
+        if node.items is not None:
+            return
+        bit = 0 if parent.children[0] is node else 1
+        if node.children[0] is None and node.children[1] is None:
+            parent.set_child(bit, None)
+        elif node.children[0] is None or node.children[1] is None:
+            parent.set_child(bit, node.children[0] or node.children[1])
+
+    def _path(self, version: int, value: int, length: int) -> typing.Iterator[_Node]:
+        """Yields every node on the path from the root whose prefix covers the given prefix"""
+        bits = ADDRESS_BITS[version]
+        node = self.roots[version]
+        while node is not None and node.length <= length:
+            if _mask(value, node.length, bits) != node.prefix:
+                break
+            yield node
+            if node.length == bits:
+                break
+            node = node.children[(value >> (bits - node.length - 1)) & 1]
+
+    def covering(self, network) -> typing.List:
+        """Returns all items whose prefix covers (contains or equals) the given network, shortest prefix first"""
+        found = []
+        for node in self._path(*to_key(network)):
+            if node.items:
+                found.extend(node.items)
+        return found
+
+    def longest_match(self, network) -> typing.Optional[typing.Any]:
+        """Returns an item stored at the most specific prefix covering the given network, or None"""
+        match = None
+        for node in self._path(*to_key(network)):
+            if node.items:
+                match = node.items[0]
+        return match
+
+    def covered(self, network, limit: int = 0) -> typing.List:
+        """Returns all items whose prefix lies within (or equals) the given network, or only the first $limit found"""
+        version, value, length = to_key(network)
+        bits = ADDRESS_BITS[version]
+        node = self.roots[version]
+        while node is not None and node.length < length:
+            if _mask(value, node.length, bits) != node.prefix:
+                return []
+            node = node.children[(value >> (bits - node.length - 1)) & 1]
+        if node is None or _mask(node.prefix, length, bits) != value:
+            return []
+        found = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.items:
+                found.extend(node.items)
+                if limit and len(found) >= limit:
+                    return found[:limit]
+            for child in node.children:
+                if child is not None:
+                    stack.append(child)
+        return found
+
+    def overlapping(self, network, limit: int = 0) -> typing.List:
+        """Returns all items that either cover or lie within the given network, or only the first $limit found"""
+        version, value, length = to_key(network)
+        found = []
+        for node in self._path(version, value, length):
+            if node.items and node.length < length:  # Exact matches are picked up by covered() below
+                found.extend(node.items)
+        if limit and len(found) >= limit:
+            return found[:limit]
+        found.extend(self.covered((version, value, length), limit - len(found) if limit else 0))
+        return found
+
+    def __len__(self):
+        return self.size
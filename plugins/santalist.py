@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import typing
+import plugins.configuration
+
+""" Santa's list: past infractions (niceness) and unblock tokens of offending IPs """
+
+LOAD_BATCH = 500  # Max number of IPs to look up per query, well below SQLite's limit on bound parameters
+
+
+class SantaList:
+    """Keeps the santa's list entries of the IPs it has been asked about in memory, reading them from the database
+    in bulk, the first time they are needed. Every change to the list goes through save(), which updates the cached
+    entry and queues the write, so the cached entry is always the latest one. Looking up IPs that are not cached
+    yet therefore never has to wait for queued writes to be flushed: none of those can be for them."""
+
+    def __init__(self, state: "plugins.configuration.BlockyConfiguration"):
+        self.state = state
+        self.entries: typing.Dict[str, typing.Optional[dict]] = {}  # None for IPs without an entry
+
+    async def load(self, ips: typing.Iterable[str]):
+        """Reads the entries of any of the given IPs that are not in memory yet, in as few queries as possible"""
+        missing = sorted(set(ip for ip in ips if ip not in self.entries))
+        for start in range(0, len(missing), LOAD_BATCH):
+            batch = missing[start : start + LOAD_BATCH]
+            rows = await self.state.db.query(
+                f"SELECT * FROM santalist WHERE ip IN ({', '.join('?' * len(batch))})", *batch, flush=False
+            )
+            found = {row["ip"]: row for row in rows}
+            for ip in batch:
+                # An entry saved while we were reading is newer than what we read
+                self.entries.setdefault(ip, found.get(ip))
+
+    def get(self, ip: str) -> typing.Optional[dict]:
+        """Returns a copy of the entry of an IP that has been loaded, or None if it has none"""
+        entry = self.entries.get(ip)
+        return dict(entry) if entry else None
+
+    def save(self, entry: dict):
+        """Stores a new or changed entry, and queues writing it to the database"""
+        self.entries[entry["ip"]] = dict(entry)
+        self.state.sqlite.upsert("santalist", dict(entry), ip=entry["ip"])
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import functools
+import re
+import sqlite3
+import threading
+import time
+import typing
+import asfpy.sqlite
+import plugins.metrics
+
+""" Write-behind SQLite storage for Blocky/4 """
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+# The table a write statement changes, so reads only have to wait for queued writes to the tables they read
+WRITE_TABLE = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[`\"\[]?(\w+)",
+    re.IGNORECASE,
+)
+
+FLUSH_DURATION = plugins.metrics.histogram(
+    "blocky_sqlite_flush_duration_seconds", "Time taken to write a batch of queued statements to SQLite"
+)
+FLUSHED_STATEMENTS = plugins.metrics.counter("blocky_sqlite_statements_total", "Statements written to SQLite")
+FLUSH_FAILURES = plugins.metrics.counter(
+    "blocky_sqlite_flush_failures_total", "Batched writes that failed and were retried one statement at a time"
+)
+
+
+def write_table(statement: str) -> typing.Optional[str]:
+    """Returns the (lower case) name of the table a write statement changes, or None if it cannot tell"""
+    match = WRITE_TABLE.match(statement)
+    return match.group(1).lower() if match else None
+
+
+class BlockyDB(asfpy.sqlite.DB):
+    """asfpy.sqlite.DB with a write-behind queue. Inserts, updates, upserts and deletes are queued instead of being
+    committed one by one, and flush() writes everything queued in a single transaction, batching runs of the same
+    statement through executemany. Reads flush pending writes first if any of them are for the table being read,
+    so they always see them. The queue keeps count of the tables it has writes for, to tell."""
+
+    def __init__(self, fp: str, journal_mode: str = "WAL", synchronous: str = "NORMAL"):
+        # Same as asfpy.sqlite.DB.__init__, but the connection may be handed over to the writer thread (see AsyncDB)
+        self.connector = sqlite3.connect(fp, isolation_level=None, check_same_thread=False)
+        self.connector.row_factory = sqlite3.Row
+        self.cursor = self.connector.cursor()
+        self.upserts_supported: bool = sqlite3.sqlite_version >= "3.25.0"
+        self.lock = threading.RLock()  # Guards the connection, which is shared between the writer thread and startup code
+        assert journal_mode.upper() in JOURNAL_MODES, f"Unknown SQLite journal mode: {journal_mode}"
+        assert synchronous.upper() in SYNCHRONOUS_MODES, f"Unknown SQLite synchronous mode: {synchronous}"
+        self.cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.cursor.execute(f"PRAGMA synchronous={synchronous}")
+        self.pending: typing.Deque[typing.Tuple[str, tuple]] = collections.deque()
+        # Number of queued writes, and of writes in the flush that is running, per table (None: unknown table)
+        self.pending_tables: typing.Counter[typing.Optional[str]] = collections.Counter()
+        self.flushing_tables: typing.Counter[typing.Optional[str]] = collections.Counter()
+        self.pending_lock = threading.Lock()  # Guards the queue and its table counts, which runc updates off-thread
+        atexit.register(self.flush)  # Don't lose queued writes on shutdown
+
+    def runc(self, cmd: str, *args):
+        """Queues a write. All of asfpy's write helpers (insert, update, upsert, delete) end up here."""
+        with self.pending_lock:
+            self.pending.append((cmd, args))
+            self.pending_tables[write_table(cmd)] += 1
+
+    def has_pending(self, table: str = None) -> bool:
+        """Returns whether there are queued (or still being written) changes to a table, or to any table if none is
+        given. Writes to tables that could not be told from their statement count as writes to every table."""
+        with self.pending_lock:
+            if table is None:
+                return bool(self.pending or self.flushing_tables)
+            table = table.lower()
+            return any(counts.get(table) or counts.get(None) for counts in (self.pending_tables, self.flushing_tables))
+
+    def is_open(self) -> bool:
+        """Returns False once the connection has been closed"""
+        try:
+            self.connector.total_changes
+            return True
+        except sqlite3.ProgrammingError:
+            return False
+
+    def flush(self) -> int:
+        """Writes all queued statements to disk in one transaction. Returns the number of statements written."""
+        with self.lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        if not self.pending or not self.is_open():
+            return 0  # Writes queued after the connection was closed stay queued, rather than being lost
+        started = time.perf_counter()
+        with self.pending_lock:
+            batch = list(self.pending)
+            self.pending.clear()
+            self.flushing_tables, self.pending_tables = self.pending_tables, collections.Counter()
+        try:
+            try:
+                self.cursor.execute("BEGIN")
+                for statement, rows in self._group(batch):
+                    self.cursor.executemany(statement, rows)
+                self.cursor.execute("COMMIT")
+            except sqlite3.Error as e:
+                if not self.is_open():
+                    # Nothing more can be done with this connection, not even a rollback
+                    self._requeue(batch)
+                    print(f"Database connection closed, keeping {len(batch)} statement(s) queued: {e}")
+                    return 0
+                # One bad statement should not take the rest of the batch down with it, so retry them one by one
+                self.cursor.execute("ROLLBACK")
+                FLUSH_FAILURES.inc()
+                print(f"Batched database write failed ({e}), retrying statements one at a time")
+                for statement, args in batch:
+                    try:
+                        self.cursor.execute(statement, args)
+                    except sqlite3.Error as e:
+                        print(f"Could not write to database: {e} ({statement})")
+        finally:
+            with self.pending_lock:
+                self.flushing_tables = collections.Counter()
+        FLUSH_DURATION.observe(time.perf_counter() - started)
+        FLUSHED_STATEMENTS.inc(len(batch))
+        return len(batch)
+
+    def _requeue(self, batch: typing.List[typing.Tuple[str, tuple]]):
+        """Puts the statements of a flush that could not be written back at the front of the queue, in order"""
+        with self.pending_lock:
+            self.pending.extendleft(reversed(batch))
+            for statement, _args in batch:
+                self.pending_tables[write_table(statement)] += 1
+
+    @staticmethod
+    def _group(batch: typing.List[typing.Tuple[str, tuple]]) -> typing.Iterator[typing.Tuple[str, typing.List[tuple]]]:
+        """Groups consecutive runs of the same statement, keeping the original order of writes"""
+        statement = None
+        rows = []
+        for x_statement, args in batch:
+            if x_statement != statement and rows:
+                yield statement, rows
+                rows = []
+            statement = x_statement
+            rows.append(args)
+        if rows:
+            yield statement, rows
+
+    def fetch(self, table: str, limit: int = 1, **params) -> typing.Iterator[dict]:
+        with self.lock:
+            if self.has_pending(table):
+                self._flush()
+            yield from super().fetch(table, limit, **params)
+
+    def iterate(self, statement: str, *args, batch: int = 10000) -> typing.Iterator[tuple]:
+        """Runs a read query on a cursor of its own, yielding plain tuples instead of sqlite3.Row objects, for bulk
+        reads such as loading the lists at startup. The connection stays locked until all rows have been read."""
+        with self.lock:
+            self._flush()
+            cursor = self.connector.cursor()
+            cursor.row_factory = None
+            cursor.execute(statement, args)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                yield from rows
+
+    def query(self, statement: str, *args) -> typing.List[sqlite3.Row]:
+        """Runs a read query that asfpy's helpers can't express (ordering, ranges, aggregates), returning all rows"""
+        with self.lock:
+            self._flush()
+            return self.cursor.execute(statement, args).fetchall()
+
+
+class AsyncDB:
+    """Async facade for running SQLite work off the event loop. Queued writes are flushed by a single writer thread
+    that owns the BlockyDB connection, while reads are served by a pool of threads with their own connections
+    (which WAL mode lets run alongside the writer). Reads flush pending writes to the table they read first, so
+    they always see them, and only then: reads of tables with nothing queued never wait for the writer."""
+
+    def __init__(self, db: BlockyDB, filepath: str, readers: int = 4):
+        self.db = db
+        self.filepath = filepath
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self.readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-reader")
+        self.local = threading.local()
+
+    def _reader(self) -> asfpy.sqlite.DB:
+        """Returns the read connection for the current reader thread, connecting if need be"""
+        if not hasattr(self.local, "db"):
+            self.local.db = asfpy.sqlite.DB(self.filepath)
+        return self.local.db
+
+    def _fetch(self, table: str, limit: int, params: dict) -> typing.List[dict]:
+        return list(self._reader().fetch(table, limit, **params))
+
+    async def flush(self, table: str = None) -> int:
+        """Writes all queued changes to disk on the writer thread, if there are any for the given table (or for any
+        table). This goes through the writer even if the only changes are those of a flush that is already running,
+        as it has taken the queue but may not have committed it yet: waiting our turn on the single writer thread
+        means that any such flush has finished by the time we return."""
+        if not self.db.has_pending(table):
+            return 0
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self.db.flush)
+
+    async def fetch(self, table: str, limit: int = 1, **params) -> typing.List[dict]:
+        """Fetches up to $limit matching rows (all rows if limit is 0 or None) as a list of dicts"""
+        await self.flush(table)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, functools.partial(self._fetch, table, limit, params)
+        )
+
+    async def query(self, statement: str, *args, table: str = None, flush: bool = True) -> typing.List[dict]:
+        """Runs a read query that asfpy's helpers can't express on a reader thread, returning all rows as dicts.
+        Queued changes to $table (or to any table, if not given) are written first, unless flush is False: for
+        callers that keep the rows they change in memory, and so never need to read back a queued change."""
+        if flush:
+            await self.flush(table)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, functools.partial(self._query, statement, args)
+        )
+
+    def _query(self, statement: str, args: tuple) -> typing.List[dict]:
+        return [dict(row) for row in self._reader().cursor.execute(statement, args).fetchall()]
+
+    async def run(self, function: typing.Callable[[BlockyDB], typing.Any]) -> typing.Any:
+        """Runs a function with the database on the writer thread, for maintenance work that writes directly"""
+        return await asyncio.get_running_loop().run_in_executor(self.writer, function, self.db)
+
+    async def fetchone(self, table: str, **params) -> typing.Optional[dict]:
+        """Fetches a single matching row, or None if no match was found"""
+        rows = await self.fetch(table, **params)  # Like asfpy's fetchone, this uses fetch's default limit of one row
+        return rows[0] if rows else None
+
+    # Writes only need to be queued, which never blocks. They are async for the sake of a uniform interface.
+    async def insert(self, table: str, document: dict):
+        self.db.insert(table, document)
+
+    async def update(self, table: str, document: dict, **target):
+        self.db.update(table, document, **target)
+
+    async def upsert(self, table: str, document: dict, **target):
+        self.db.upsert(table, document, **target)
+
+    async def delete(self, table: str, **target):
+        self.db.delete(table, **target)
+
+
+async def run(db: AsyncDB, interval: int):
+    """Flushes queued writes every $interval milliseconds"""
+    while True:
+        await asyncio.sleep(interval / 1000)
+        await db.flush()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import typing
+
+""" Sliding-window per-IP counters for incremental ban rules """
+
+
+class SlidingWindow:
+    """Keeps per-IP counters over a sliding time window, in a ring buffer of fixed-width time buckets.
+    When a bucket slides out of the window, its counts are subtracted from the running totals, so totals
+    always reflect the current window without having to re-add every bucket."""
+
+    def __init__(self, window_seconds: int, bucket_seconds: int = 60):
+        self.bucket_seconds = bucket_seconds
+        self.size = max(1, math.ceil(window_seconds / bucket_seconds))
+        self.window_seconds = window_seconds
+        self.starts: typing.List[typing.Optional[int]] = [None] * self.size  # Start time of each bucket
+        self.buckets: typing.List[typing.Optional[typing.Dict[str, int]]] = [None] * self.size
+        self.totals: typing.Dict[str, int] = {}
+        self.cutoff = 0  # Buckets starting before this are outside the window
+
+    def _clear(self, slot: int):
+        bucket = self.buckets[slot]
+        if bucket:
+            for ip, value in bucket.items():
+                total = self.totals[ip] - value
+                if total > 0:
+                    self.totals[ip] = total
+                else:
+                    del self.totals[ip]
+        self.starts[slot] = None
+        self.buckets[slot] = None
+
+    def add(self, timestamp: int, ip: str, value: int):
+        """Adds a value for an IP at the given time (epoch seconds). Values older than the window are ignored."""
+        start = timestamp - timestamp % self.bucket_seconds
+        if start < self.cutoff:
+            return
+        slot = (start // self.bucket_seconds) % self.size
+        if self.starts[slot] != start:
+            if self.starts[slot] is not None and self.starts[slot] > start:
+                return  # Slot has already moved on to a newer bucket, so this one is out of the window
+            self._clear(slot)
+            self.starts[slot] = start
+            self.buckets[slot] = {}
+        bucket = self.buckets[slot]
+        bucket[ip] = bucket.get(ip, 0) + value
+        self.totals[ip] = self.totals.get(ip, 0) + value
+
+    def expire(self, now: int):
+        """Slides the window forward to end at $now, dropping any buckets that fall out of it"""
+        self.cutoff = now - self.window_seconds
+        for slot in range(self.size):
+            start = self.starts[slot]
+            if start is not None and start + self.bucket_seconds <= self.cutoff:
+                self._clear(slot)
+
+    def over(self, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        """Returns all (ip, total) pairs whose total within the window is at or above the limit, highest first"""
+        return sorted(
+            ((ip, total) for ip, total in self.totals.items() if total >= limit), key=lambda x: x[1], reverse=True
+        )
+
+    def __len__(self):
+        return len(self.totals)
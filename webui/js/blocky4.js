@@ -24,6 +24,9 @@ async function METHOD(method = 'POST', url = '', data) {
     }
 }
 
+// Number of allow list entries to fetch per page
+const ALLOW_PAGE_SIZE = 100;
+
 // HTTP methods
 let DELETE = (url, data) => METHOD('DELETE', url, data);
 let GET = (url, data) => METHOD('GET', url, data);
@@ -514,7 +517,6 @@ async function save_allow() {
 
 
 async function prime_allow() {
-    let all = await GET("all?short=block");
     let main = document.getElementById('main');
     main.innerHTML = "";
 
@@ -609,10 +611,8 @@ async function prime_allow() {
     main.appendChild(_hr());
 
 
-    let allow_count = all.allow.length.pretty();
-    let h1 = _h1(`Allowed IPs (${allow_count} entries in total)`);
+    let h1 = _h1("Allowed IPs");
     main.appendChild(h1);
-    all.allow.sort((a,b) => b.timestamp - a.timestamp);  // sort desc by timestamp
 
 
     // Current entries in allow list
@@ -629,35 +629,48 @@ async function prime_allow() {
     theader.appendChild(_th('Actions', 100));
     activity_table.appendChild(theader);
 
+    // Entries are fetched a page at a time (newest first), with a link at the bottom for fetching the next page
+    let more = _a("Show more entries...");
+    more.setAttribute("href", 'javascript:void(0);');
+    more.style.display = "none";
+    main.appendChild(more);
     let results_shown = 0;
-    for (const entry of all.allow) {
-        let tr = _tr();
-        let td_ip = _td(entry.ip);
-        td_ip.style.fontFamily = "monospace";
-        if (entry.ip.length > 16) td_ip.style.fontSize = "0.8rem";
-        let td_added = _td(moment(entry.timestamp*1000.0).fromNow());
-        let td_expires = _td(entry.expires > 0 ? moment(entry.expires*1000.0).fromNow() : 'Never');
-        let td_reason = _td(entry.reason);
-        let td_host = _td(entry.host);
-        let td_action = _td();
-        td_action.appendChild(unblock_link(entry, true));
-        tr.appendChild(td_ip);
-        tr.appendChild(td_added);
-        tr.appendChild(td_expires);
-        tr.appendChild(td_reason);
-        tr.appendChild(td_host);
-        tr.appendChild(td_action);
-        activity_table.appendChild(tr);
-        results_shown++;
-    }
-    if (results_shown === 0) {
-        let tr = _tr();
-        tr.innerText = "No entries found...";
-        activity_table.appendChild(_tr);
-    }
-
-
+    let after = null;
 
+    async function show_page() {
+        more.style.display = "none";
+        let page = await GET(`all?type=allow&sort=-timestamp&limit=${ALLOW_PAGE_SIZE}` + (after ? `&after=${encodeURIComponent(after)}` : ''));
+        h1.innerText = `Allowed IPs (${page.total.pretty()} entries in total)`;
+        for (const entry of page.entries) {
+            let tr = _tr();
+            let td_ip = _td(entry.ip);
+            td_ip.style.fontFamily = "monospace";
+            if (entry.ip.length > 16) td_ip.style.fontSize = "0.8rem";
+            let td_added = _td(moment(entry.timestamp*1000.0).fromNow());
+            let td_expires = _td(entry.expires > 0 ? moment(entry.expires*1000.0).fromNow() : 'Never');
+            let td_reason = _td(entry.reason);
+            let td_host = _td(entry.host);
+            let td_action = _td();
+            td_action.appendChild(unblock_link(entry, true));
+            tr.appendChild(td_ip);
+            tr.appendChild(td_added);
+            tr.appendChild(td_expires);
+            tr.appendChild(td_reason);
+            tr.appendChild(td_host);
+            tr.appendChild(td_action);
+            activity_table.appendChild(tr);
+            results_shown++;
+        }
+        if (results_shown === 0) {
+            let tr = _tr();
+            tr.innerText = "No entries found...";
+            activity_table.appendChild(tr);
+        }
+        after = page.next;
+        if (after) more.style.display = "block";
+    }
+    more.addEventListener('click', () => show_page());
+    await show_page();
 }
 
 
@@ -686,7 +699,6 @@ async function save_block() {
 
 
 async function prime_block() {
-    let all = await GET("all");
     let main = document.getElementById('main');
     main.innerHTML = "";
 